@@ -0,0 +1,68 @@
+import itertools
+
+
+class AudioTurn:
+    def __init__(self, turnId, holders):
+        self.turnId = turnId
+        self.holders = set(holders)  # Connection ids still playing this turn's audio
+        self.task = None
+        self.pins = []  # TTS cache keys kept resident while the turn is playing
+
+
+class AudioSessions:
+    """Per-connection, per-turn namespaces for spoken replies
+
+    Every reply gets its own turn id, carried on each audio frame, so clients
+    never mix up audio from different turns or users. A turn is held by each
+    connection it is sent to and released when that client acknowledges
+    playback or disconnects. When the last holder lets go, synthesis still in
+    flight is cancelled and the turn's cache entries are unpinned.
+    """
+
+    def __init__(self, cache=None):
+        self.cache = cache
+        self.turns = {}
+        self.counter = itertools.count(1)
+
+    def startTurn(self, holders):
+        turnId = f"turn-{next(self.counter)}"
+        self.turns[turnId] = AudioTurn(turnId, holders)
+        return turnId
+
+    def attach(self, turnId, task):
+        turn = self.turns.get(turnId)
+        if turn is None:
+            task.cancel()  # Every listener left before synthesis even started
+        else:
+            turn.task = task
+
+    def pinner(self, turnId):
+        """Callback for TTS that pins each cache key the turn uses, for as long as the turn is live"""
+        def pin(key):
+            turn = self.turns.get(turnId)
+            # Synthesis can finish after the turn is cleaned up, and nothing would unpin it then
+            if turn is None or self.cache is None:
+                return
+            self.cache.pin(key)
+            turn.pins.append(key)
+        return pin
+
+    def release(self, turnId, connectionId):
+        turn = self.turns.get(turnId)
+        if turn is None:
+            return
+        turn.holders.discard(connectionId)
+        if not turn.holders:
+            self.cleanup(turn)
+
+    def disconnect(self, connectionId):
+        for turn in list(self.turns.values()):
+            self.release(turn.turnId, connectionId)
+
+    def cleanup(self, turn):
+        del self.turns[turn.turnId]
+        if turn.task and not turn.task.done():
+            turn.task.cancel()
+        for key in turn.pins:
+            self.cache.unpin(key)
+        turn.pins.clear()
@@ -0,0 +1,186 @@
+import asyncio
+import json
+import os
+import struct
+from collections import deque
+
+import metrics
+
+WS_QUEUE_SIZE = int(os.getenv("WS_QUEUE_SIZE", "64"))
+WS_SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", "10"))
+
+# Progress notices a lagging client can live without: the final text reply still arrives
+DROPPABLE_TYPES = {"tool_executing", "tool_success"}
+# Audio is never cut mid-chunk: once any of a turn's audio is dropped, the rest of that turn goes too
+AUDIO_TYPES = {"audio_chunk", "audio_frame"}
+
+
+class ClientChannel:
+    """Bounded outbound queue of one websocket, emptied by its own sender task"""
+
+    def __init__(self, websocket, maxQueue):
+        self.websocket = websocket
+        self.maxQueue = maxQueue
+        self.queue = deque()  # (type, payload, droppable, turn), payload is str for JSON or bytes for binary frames
+        self.droppedTurns = set()  # Turns whose remaining audio is skipped for this client
+        self.ready = asyncio.Event()
+        self.degraded = False
+        self.closed = False
+        self.task = None
+
+
+class BroadcastHub:
+    """Fan-out of websocket messages with one bounded queue and sender task per client
+
+    Senders never await a client directly, so a slow or half-dead browser only
+    backs up its own queue. When a queue is full, droppable messages are shed and
+    the client is downgraded to the essential messages until it catches up.
+    Audio is shed a whole turn at a time, from the first dropped piece to the
+    end of the turn, so playback stops rather than skipping mid-word. A client
+    that cannot even keep up with the essentials is disconnected.
+    """
+
+    def __init__(self, maxQueue=WS_QUEUE_SIZE, sendTimeout=WS_SEND_TIMEOUT):
+        self.maxQueue = maxQueue
+        self.sendTimeout = sendTimeout
+        self.channels = {}
+
+    def register(self, websocket):
+        channel = ClientChannel(websocket, self.maxQueue)
+        channel.task = asyncio.create_task(self.sender(channel))
+        self.channels[websocket] = channel
+
+    async def unregister(self, websocket):
+        channel = self.channels.pop(websocket, None)
+        if channel and channel.task:
+            channel.closed = True
+            channel.task.cancel()
+            await asyncio.gather(channel.task, return_exceptions=True)
+
+    def clients(self):
+        return len(self.channels)
+
+    def websockets(self):
+        return list(self.channels)
+
+    def send(self, websocket, data):
+        """Queue one message for a single client. Returns False if it was dropped"""
+        channel = self.channels.get(websocket)
+        if channel is None:
+            return False
+        return self.enqueue(channel, data.get("type", ""), json.dumps(data), data.get("turn_id"))
+
+    def broadcast(self, data):
+        """Queue one message for every connected client, serialized once"""
+        text = json.dumps(data)
+        messageType = data.get("type", "")
+        for channel in list(self.channels.values()):
+            self.enqueue(channel, messageType, text, data.get("turn_id"))
+
+    def sendBinary(self, websocket, header, data):
+        """Queue a binary frame for a single client, see encodeFrame"""
+        channel = self.channels.get(websocket)
+        if channel is None:
+            return False
+        return self.enqueue(channel, header.get("type", ""), encodeFrame(header, data), header.get("turn_id"))
+
+    def broadcastBinary(self, header, data):
+        frame = encodeFrame(header, data)
+        messageType = header.get("type", "")
+        for channel in list(self.channels.values()):
+            self.enqueue(channel, messageType, frame, header.get("turn_id"))
+
+    def enqueue(self, channel, messageType, payload, turn=None):
+        if channel.closed:
+            return False
+        audio = messageType in AUDIO_TYPES
+        droppable = audio or messageType in DROPPABLE_TYPES
+
+        if messageType == "audio_end":
+            channel.droppedTurns.discard(turn)
+        if audio and turn in channel.droppedTurns:
+            metrics.websocketDropped.inc(type=messageType, reason="turn")
+            return False
+
+        if droppable and channel.degraded:
+            self.dropped(channel, messageType, turn, "degraded")
+            return False
+
+        if len(channel.queue) >= channel.maxQueue:
+            channel.degraded = True
+            if droppable:
+                self.dropped(channel, messageType, turn, "overflow")
+                return False
+            # Make room by shedding the oldest queued message that can be spared
+            for i, (queuedType, _, queuedDroppable, queuedTurn) in enumerate(channel.queue):
+                if queuedDroppable:
+                    del channel.queue[i]
+                    self.dropped(channel, queuedType, queuedTurn, "overflow", i)
+                    break
+            else:
+                print(f"⚠️ Client {id(channel.websocket)} fell too far behind, disconnecting")
+                self.disconnect(channel)
+                return False
+
+        channel.queue.append((messageType, payload, droppable, turn))
+        channel.ready.set()
+        return True
+
+    def dropped(self, channel, messageType, turn, reason, position=None):
+        """Count a dropped message. For audio, skip the rest of its turn from position on in the queue"""
+        metrics.websocketDropped.inc(type=messageType, reason=reason)
+        if messageType not in AUDIO_TYPES:
+            return
+        channel.droppedTurns.add(turn)
+        if position is None:
+            return  # The newest message, nothing of its turn is queued behind it
+        # Audio of the turn queued after the dropped piece goes too, so no hole opens up mid-turn
+        kept = deque()
+        for i, item in enumerate(channel.queue):
+            if i >= position and item[0] in AUDIO_TYPES and item[3] == turn:
+                metrics.websocketDropped.inc(type=item[0], reason="turn")
+            else:
+                kept.append(item)
+        channel.queue = kept
+
+    def disconnect(self, channel):
+        channel.closed = True
+        channel.queue.clear()
+        self.channels.pop(channel.websocket, None)
+        # Closing the socket ends the endpoint's receive loop, which cleans up the rest
+        asyncio.create_task(closeQuietly(channel.websocket))
+        if channel.task and channel.task is not asyncio.current_task():
+            channel.task.cancel()
+
+    async def sender(self, channel):
+        while not channel.closed:
+            if not channel.queue:
+                channel.ready.clear()
+                await channel.ready.wait()
+                continue
+
+            messageType, payload, _, _ = channel.queue.popleft()
+            send = channel.websocket.send_bytes if isinstance(payload, bytes) else channel.websocket.send_text
+            try:
+                with metrics.websocketSendLatency.time(type=messageType):
+                    await asyncio.wait_for(send(payload), timeout=self.sendTimeout)
+            except Exception as e:
+                print(f"Failed to send to client: {e or type(e).__name__}")
+                self.disconnect(channel)
+                return
+
+            if channel.degraded and not channel.queue:
+                channel.degraded = False
+
+
+def encodeFrame(header, data):
+    """Binary websocket frame: 4 byte big-endian header length, the JSON header, then the raw bytes"""
+    headerBytes = json.dumps(header).encode("utf-8")
+    return struct.pack(">I", len(headerBytes)) + headerBytes + data
+
+
+async def closeQuietly(websocket):
+    try:
+        await websocket.close()
+    except Exception:
+        pass
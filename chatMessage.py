@@ -1,4 +1,5 @@
 import sqlite3
+import metrics
 class ChatMessage:
     def __init__(self, dbFilename):
         self.conn = sqlite3.connect(dbFilename)
@@ -13,14 +14,21 @@ CREATE TABLE IF NOT EXISTS messages (
         self.conn.commit()
 
     def saveMessage(self, role, content):
-        self.cursor.execute("INSERT INTO messages (role, content) VALUES (?, ?)", (role, content))
-        self.conn.commit()
+        with metrics.dbLatency.time(operation="save"):
+            self.cursor.execute("INSERT INTO messages (role, content) VALUES (?, ?)", (role, content))
+            self.conn.commit()
 
     def getMessageHistory(self, limit = 10):
-        self.cursor.execute("SELECT role, content FROM messages ORDER by id DESC LIMIT ?", (limit,))
-        rows = self.cursor.fetchall()
+        with metrics.dbLatency.time(operation="read"):
+            self.cursor.execute("SELECT role, content FROM messages ORDER by id DESC LIMIT ?", (limit,))
+            rows = self.cursor.fetchall()
         return[{"role": role, "content": content} for role, content in rows[::-1]]
     
+    def latestId(self):
+        """Id of the newest message, which only grows, so callers can tell whether the conversation moved on"""
+        self.cursor.execute("SELECT COALESCE(MAX(id), 0) FROM messages")
+        return self.cursor.fetchone()[0]
+
     def clearHistory(self):
         self.cursor.execute("DELETE FROM messages")
         self.conn.commit()
\ No newline at end of file
@@ -0,0 +1,151 @@
+import csv
+import json
+import os
+import sqlite3
+import sys
+
+try:
+    from mcpServers.textMatch import normalizeTitle, trigrams, similarity
+except ImportError:
+    from textMatch import normalizeTitle, trigrams, similarity
+
+defaultCatalogDb = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "animeCatalog.db")
+
+# Field names used by the Jikan API and the common Kaggle / anime-offline-database dumps
+FIELD_ALIASES = {
+    "mal_id": ("mal_id", "anime_id", "MAL_ID", "id"),
+    "title": ("title", "name", "Name"),
+    "titleEnglish": ("title_english", "english_name", "English name", "English"),
+    "type": ("type", "Type"),
+    "year": ("year", "Year", "start_year"),
+    "episodes": ("episodes", "Episodes"),
+    "status": ("status", "Status"),
+}
+
+
+def readField(record, field):
+    for alias in FIELD_ALIASES[field]:
+        value = record.get(alias)
+        if value not in (None, "", "Unknown", "UNKNOWN"):
+            return value
+    return None
+
+
+def toInt(value):
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+class AnimeCatalog:
+    """Local, indexed copy of an anime dataset dump with fuzzy title search"""
+
+    def __init__(self, path=None):
+        self.conn = sqlite3.connect(path or os.getenv("ANIME_CATALOG_DB", defaultCatalogDb), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript("""
+CREATE TABLE IF NOT EXISTS catalog (
+    mal_id INTEGER PRIMARY KEY,
+    title TEXT NOT NULL,
+    titleEnglish TEXT,
+    type TEXT,
+    year INTEGER,
+    episodes INTEGER,
+    status TEXT
+);
+CREATE TABLE IF NOT EXISTS catalog_trigram (
+    trigram TEXT NOT NULL,
+    malId INTEGER NOT NULL,
+    PRIMARY KEY (trigram, malId)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_catalog_year ON catalog(year);
+CREATE INDEX IF NOT EXISTS idx_catalog_type ON catalog(type);
+""")
+        self.conn.commit()
+
+    def size(self):
+        return self.conn.execute("SELECT COUNT(*) FROM catalog").fetchone()[0]
+
+    def importDump(self, dumpPath):
+        """Bulk load a JSON or CSV dump, replacing entries with the same mal_id"""
+        if dumpPath.lower().endswith(".csv"):
+            with open(dumpPath, newline="", encoding="utf-8") as f:
+                records = list(csv.DictReader(f))
+        else:
+            with open(dumpPath, "r", encoding="utf-8") as f:
+                records = json.load(f)
+            if isinstance(records, dict):
+                records = records.get("data", [])
+
+        rows = []
+        grams = []
+        for record in records:
+            malId = toInt(readField(record, "mal_id"))
+            title = readField(record, "title")
+            if malId is None or not title:
+                continue
+            titleEnglish = readField(record, "titleEnglish")
+            year = toInt(readField(record, "year"))
+            if year is None:
+                # Jikan shaped records only carry the year inside "aired"
+                year = toInt(((record.get("aired") or {}).get("prop") or {}).get("from", {}).get("year"))
+            rows.append((malId, title, titleEnglish, readField(record, "type"), year,
+                         toInt(readField(record, "episodes")), readField(record, "status")))
+            titleGrams = trigrams(normalizeTitle(title)) | trigrams(normalizeTitle(titleEnglish))
+            grams.extend((gram, malId) for gram in titleGrams)
+
+        with self.conn:
+            self.conn.executemany("DELETE FROM catalog_trigram WHERE malId = ?", [(row[0],) for row in rows])
+            self.conn.executemany("INSERT OR REPLACE INTO catalog VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            self.conn.executemany("INSERT OR IGNORE INTO catalog_trigram (trigram, malId) VALUES (?, ?)", grams)
+        return len(rows)
+
+    def search(self, query, year=None, animeType=None, limit=10, minScore=0.5):
+        """Fuzzy title search, best match first. Returns dicts shaped like the catalog rows plus a score"""
+        queryGrams = trigrams(normalizeTitle(query))
+        if not queryGrams:
+            return []
+
+        conditions = [f"t.trigram IN ({','.join('?' * len(queryGrams))})"]
+        params = list(queryGrams)
+        if year:
+            conditions.append("c.year = ?")
+            params.append(year)
+        if animeType:
+            conditions.append("c.type = ? COLLATE NOCASE")
+            params.append(animeType)
+
+        rows = self.conn.execute(
+            "SELECT c.mal_id, c.title, c.titleEnglish, c.type, c.year, c.episodes, c.status "
+            "FROM catalog_trigram t JOIN catalog c ON c.mal_id = t.malId "
+            f"WHERE {' AND '.join(conditions)} "
+            "GROUP BY c.mal_id ORDER BY COUNT(*) DESC LIMIT 50",
+            params,
+        ).fetchall()
+
+        results = []
+        for malId, title, titleEnglish, type, rowYear, episodes, status in rows:
+            score = 0.0
+            for candidate in (title, titleEnglish):
+                if not candidate:
+                    continue
+                titleGrams = trigrams(normalizeTitle(candidate))
+                # Favour titles without many extra words, so "naruto" ranks Naruto above its spin-offs
+                score = max(score, similarity(queryGrams, titleGrams) - 0.2 * (1 - similarity(titleGrams, queryGrams)))
+            if score >= minScore:
+                results.append({"mal_id": malId, "title": title, "title_english": titleEnglish, "type": type,
+                                "year": rowYear, "episodes": episodes, "status": status, "score": score})
+
+        results.sort(key=lambda result: result["score"], reverse=True)
+        return results[:limit]
+
+
+if __name__ == "__main__":
+    # python animeCatalog.py import anime.json
+    if len(sys.argv) == 3 and sys.argv[1] == "import":
+        catalog = AnimeCatalog()
+        count = catalog.importDump(sys.argv[2])
+        print(f"Imported {count} anime, catalog now holds {catalog.size()}")
+    else:
+        print("Usage: python animeCatalog.py import <dump.json|dump.csv>")
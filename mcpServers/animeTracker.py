@@ -1,9 +1,172 @@
 import sqlite3
 import os
+import sys
+from typing import List, Optional
+from pydantic import BaseModel
 from mcp.server.fastmcp import FastMCP
 
+try:
+    from mcpServers.textMatch import normalizeTitle, trigrams, similarity
+except ImportError:
+    from textMatch import normalizeTitle, trigrams, similarity
+
 mcp = FastMCP("Anime-Episodes-Tracker")
-db = "/home/ben/chatbot/mydatabase.db"
+
+# Set ANIME_TRACKER_DB in the server's "env" in mcpConfig.json, or pass the path as the first argument
+defaultDb = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "mydatabase.db")
+db = sys.argv[1] if len(sys.argv) > 1 else os.getenv("ANIME_TRACKER_DB", defaultDb)
+
+# Statements are kept as constants so sqlite3's per-connection statement cache reuses the prepared versions
+CREATE_ANIME_TABLE = "CREATE TABLE IF NOT EXISTS anime (id INTEGER PRIMARY KEY, title TEXT UNIQUE, episodesWatched INTEGER, totalEpisodes INTEGER, titleNorm TEXT)"
+CREATE_TRIGRAM_TABLE = "CREATE TABLE IF NOT EXISTS anime_trigram (trigram TEXT NOT NULL, animeId INTEGER NOT NULL, PRIMARY KEY (trigram, animeId)) WITHOUT ROWID"
+# Bumped whenever normalizeTitle changes, so stored titleNorm values are recomputed once rather than on every start
+TITLE_NORM_VERSION = 2
+CREATE_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_anime_titleNorm ON anime(titleNorm)",
+    # Partial index so "what am I still watching" never touches finished shows
+    "CREATE INDEX IF NOT EXISTS idx_anime_incomplete ON anime(titleNorm) WHERE episodesWatched < totalEpisodes",
+]
+SELECT_ANIME_PAGE = "SELECT id, title, episodesWatched, totalEpisodes FROM anime ORDER BY id LIMIT ? OFFSET ?"
+COUNT_ANIME = "SELECT COUNT(*) FROM anime"
+INSERT_ANIME = "INSERT INTO anime (title, episodesWatched, totalEpisodes, titleNorm) VALUES (?, ?, ?, ?)"
+SELECT_ID_BY_TITLE = "SELECT id FROM anime WHERE title = ?"
+SELECT_BY_ID = "SELECT id, title, episodesWatched, totalEpisodes FROM anime WHERE id = ?"
+SELECT_BY_TITLE = "SELECT id, title, episodesWatched, totalEpisodes FROM anime WHERE title = ?"
+SELECT_BY_TITLE_NORM = "SELECT id, title, episodesWatched, totalEpisodes FROM anime WHERE titleNorm = ?"
+UPDATE_PROGRESS_BY_ID = "UPDATE anime SET episodesWatched = ? WHERE id = ?"
+DELETE_TRIGRAMS = "DELETE FROM anime_trigram WHERE animeId = ?"
+INSERT_TRIGRAM = "INSERT OR IGNORE INTO anime_trigram (trigram, animeId) VALUES (?, ?)"
+
+# How sure the resolver has to be before it picks a title on its own
+MIN_MATCH_SCORE = 0.6
+MIN_MATCH_MARGIN = 0.15
+# A missing totalEpisodes keeps whatever count is already stored
+UPSERT_ANIME = """
+INSERT INTO anime (title, episodesWatched, totalEpisodes, titleNorm) VALUES (?, ?, ?, ?)
+ON CONFLICT(title) DO UPDATE SET
+    episodesWatched = excluded.episodesWatched,
+    totalEpisodes = COALESCE(excluded.totalEpisodes, anime.totalEpisodes)
+"""
+
+
+class AnimeEntry(BaseModel):
+    title: str
+    episodesWatched: int
+    totalEpisodes: Optional[int] = None
+
+
+class AnimeProgress(BaseModel):
+    title: str
+    episodesWatched: int
+
+
+def openDatabase(path):
+    """Open the long lived connection and make sure the schema exists, once per server start"""
+    conn = sqlite3.connect(path, check_same_thread=False, cached_statements=64)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(CREATE_ANIME_TABLE)
+    conn.execute(CREATE_TRIGRAM_TABLE)
+
+    # Databases created before titleNorm existed get the column added and backfilled once
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(anime)")]
+    if "titleNorm" not in columns:
+        conn.execute("ALTER TABLE anime ADD COLUMN titleNorm TEXT")
+    rows = conn.execute("SELECT id, title FROM anime WHERE titleNorm IS NULL").fetchall()
+    conn.executemany("UPDATE anime SET titleNorm = ? WHERE id = ?", [(normalizeTitle(title), id) for id, title in rows])
+
+    # Titles normalized by an older normalizeTitle, such as non-ascii ones that used to fold to ""
+    if conn.execute("PRAGMA user_version").fetchone()[0] < TITLE_NORM_VERSION:
+        rows = conn.execute("SELECT id, title FROM anime").fetchall()
+        for id, title in rows:
+            titleNorm = normalizeTitle(title)
+            conn.execute("UPDATE anime SET titleNorm = ? WHERE id = ?", (titleNorm, id))
+            indexTitle(conn, id, titleNorm)
+        conn.execute(f"PRAGMA user_version = {TITLE_NORM_VERSION}")
+
+    for statement in CREATE_INDEXES:
+        conn.execute(statement)
+
+    # Rows added before the trigram index existed
+    rows = conn.execute("SELECT id, titleNorm FROM anime WHERE id NOT IN (SELECT DISTINCT animeId FROM anime_trigram)").fetchall()
+    for id, titleNorm in rows:
+        indexTitle(conn, id, titleNorm)
+    conn.commit()
+    return conn
+
+
+def indexTitle(conn, animeId, titleNorm):
+    conn.execute(DELETE_TRIGRAMS, (animeId,))
+    conn.executemany(INSERT_TRIGRAM, [(gram, animeId) for gram in trigrams(titleNorm)])
+
+
+def resolveAnime(titleOrId):
+    """Find the tracked anime meant by an id, an exact title or an approximate one
+
+    Returns (row, candidates). row is set when there is one clear match,
+    otherwise candidates lists the closest rows so the user can pick.
+    """
+    titleOrId = str(titleOrId).strip()
+    if titleOrId.isdigit():
+        row = conn.execute(SELECT_BY_ID, (int(titleOrId),)).fetchone()
+        if row:
+            return row, []
+
+    row = conn.execute(SELECT_BY_TITLE, (titleOrId,)).fetchone()
+    if row:
+        return row, []
+
+    queryNorm = normalizeTitle(titleOrId)
+    rows = conn.execute(SELECT_BY_TITLE_NORM, (queryNorm,)).fetchall()
+    if len(rows) == 1:
+        return rows[0], []
+
+    queryGrams = trigrams(queryNorm)
+    if not queryGrams:
+        return None, []
+
+    # Only titles sharing at least one trigram are scored, straight from the trigram index
+    placeholders = ",".join("?" * len(queryGrams))
+    candidateIds = [r[0] for r in conn.execute(
+        f"SELECT animeId FROM anime_trigram WHERE trigram IN ({placeholders}) GROUP BY animeId ORDER BY COUNT(*) DESC LIMIT 10",
+        list(queryGrams),
+    )]
+
+    scored = []
+    for animeId in candidateIds:
+        candidate = conn.execute(SELECT_BY_ID, (animeId,)).fetchone()
+        titleGrams = trigrams(normalizeTitle(candidate[1]))
+        # Small penalty for extra words so "naruto" prefers "Naruto" over "Naruto Shippuden"
+        score = similarity(queryGrams, titleGrams) - 0.1 * (1 - similarity(titleGrams, queryGrams))
+        scored.append((score, candidate))
+    scored.sort(key=lambda item: item[0], reverse=True)
+
+    if not scored or scored[0][0] < MIN_MATCH_SCORE / 2:
+        return None, []
+    best = scored[0][0]
+    second = scored[1][0] if len(scored) > 1 else 0
+    if best >= MIN_MATCH_SCORE and best - second >= MIN_MATCH_MARGIN:
+        return scored[0][1], []
+    return None, [candidate for score, candidate in scored[:5] if score >= MIN_MATCH_SCORE / 2]
+
+
+def formatCandidates(title, candidates):
+    lines = "\n".join(f"{r[0]} | {r[1]} | {r[2]} | {r[3]}" for r in candidates)
+    return (f"'{title}' matches more than one anime. Ask the user which one they meant, "
+            f"then call again with its id.\nid | title | episodes watched | total episodes\n{lines}")
+
+
+def formatRows(rows, total, offset):
+    header = "id | title | episodes watched | total episodes\n"
+    data = "\n".join(f"{r[0]} | {r[1]} | {r[2]} | {r[3]}" for r in rows)
+    shown = f"Showing {offset + 1}-{offset + len(rows)} of {total}" if rows else f"No rows (total {total})"
+    if offset + len(rows) < total:
+        shown += f", use offset={offset + len(rows)} for more"
+    return header + data + "\n" + shown
+
+
+conn = openDatabase(db)
+
 # @mcp.resource("Anime-Episodes-Tracker://anime",
 #               description=("A table of all tracked anime. "
 #                           "Each row has the following fields:\n"
@@ -12,22 +175,20 @@ db = "/home/ben/chatbot/mydatabase.db"
 #                           "- episodesWatched: integer, how many episodes the user has watched.\n"
 #                           "- totalEpisodes: integer, the total number of episodes in the series (if known)."))
 @mcp.tool()
-def getAnimeTable() ->str:
-    "This tool returns the animes tracked within the database. You can use this tool to see how the anime title is formatted so you can use the title to update the anime"
-    db_path = "mydatabase.db"
-
-    conn = sqlite3.connect(db)
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, title, episodesWatched, totalEpisodes FROM anime")
-    rows = cursor.fetchall()
-    conn.close()  # Fixed: added parentheses
-    
-    header = "id | title | episodes watched | total episodes\n"
-    data = "\n".join(
-        [f"{r[0]} | {r[1]} | {r[2]} | {r[3]}" for r in rows]
-    )
-    data = "getAnimeTable executed sucessfully with the return info: \n"+ header + data + "\n"f"Database location: {os.path.abspath(db_path)}"
-    
+def getAnimeTable(limit: int = 50, offset: int = 0) ->str:
+    """This tool returns the animes tracked within the database, one page at a time.
+    To look up how one title is spelled, use findAnime instead.
+    Args:
+        limit: how many rows to return
+        offset: how many rows to skip
+    """
+    limit = max(1, min(limit, 200))
+    offset = max(0, offset)
+    rows = conn.execute(SELECT_ANIME_PAGE, (limit, offset)).fetchall()
+    total = conn.execute(COUNT_ANIME).fetchone()[0]
+
+    data = "getAnimeTable executed sucessfully with the return info: \n" + formatRows(rows, total, offset) + "\n"f"Database location: {os.path.abspath(db)}"
+
     # return TextResourceContents(
     #     uri="Anime-Episodes-Tracker://anime",
     #     mimeType="text/plain",
@@ -36,35 +197,64 @@ def getAnimeTable() ->str:
 
     return(str(data))
 
-def checkIfTableExists():
-    conn = sqlite3.connect(db)
-    cursor = conn.cursor()
-    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='anime'")
-    result = cursor.fetchone()
-    if result is None:
-        cursor.execute("CREATE TABLE anime (id INTEGER PRIMARY KEY, title TEXT UNIQUE, episodesWatched INTEGER, totalEpisodes INTEGER)")
-    conn.commit()
-    conn.close() 
+@mcp.tool()
+def findAnime(query: str = "", match: str = "substring", status: str = "all", limit: int = 20, offset: int = 0) -> str:
+    """
+    Find tracked anime by title. Use this to get the exact title before updating an anime's progress.
+    Args:
+        query: part of the title to look for, case and punctuation are ignored. Leave empty to list everything
+        match: "prefix" to match the start of the title or "substring" to match anywhere in it
+        status: "all", "watching" for shows with episodes left, or "completed" for finished shows
+        limit: how many rows to return
+        offset: how many rows to skip
+    """
+    limit = max(1, min(limit, 200))
+    offset = max(0, offset)
+    conditions = []
+    params = []
+
+    queryNorm = normalizeTitle(query)
+    if query.strip() and not queryNorm:
+        # Only punctuation, which would otherwise match every title
+        return "findAnime executed sucessfully with the return info: \n" + formatRows([], 0, offset)
+    if queryNorm:
+        if match == "prefix":
+            # A range scan on idx_anime_titleNorm, unlike LIKE which sqlite won't index here
+            conditions.append("titleNorm >= ? AND titleNorm < ?")
+            params.extend([queryNorm, queryNorm + "\uffff"])
+        else:
+            conditions.append("instr(titleNorm, ?) > 0")
+            params.append(queryNorm)
+
+    if status == "watching":
+        conditions.append("episodesWatched < totalEpisodes")
+    elif status == "completed":
+        conditions.append("episodesWatched >= totalEpisodes")
+
+    where = (" WHERE " + " AND ".join(conditions)) if conditions else ""
+    total = conn.execute("SELECT COUNT(*) FROM anime" + where, params).fetchone()[0]
+    rows = conn.execute(
+        "SELECT id, title, episodesWatched, totalEpisodes FROM anime" + where + " ORDER BY titleNorm LIMIT ? OFFSET ?",
+        params + [limit, offset],
+    ).fetchall()
+
+    return "findAnime executed sucessfully with the return info: \n" + formatRows(rows, total, offset)
 
 @mcp.tool()
 def insertNewAnime(title: str, episodesWatched: int, totalEpisodes: int):
     """
     This tool allows to enter in a new anime into the database.
-    If user does not give you the anime's total episode count, then use the searchAnime and getAnimeInfo tools to get the episode count. 
+    If user does not give you the anime's total episode count, then use the searchAnime and getAnimeInfo tools to get the episode count.
     If the searchAnime and getAnimeInfo tool is not available then ask the user for the information
     Args:
         title: title of the anime to entered in. This parameter should only be the show's title and not include extra information like this: (TV, 2004)
         episodesWatched: the number of episodes the user have already watched
         totalEpisodes: the total number of episodes in the anime series
     """
-    checkIfTableExists()
-    conn = sqlite3.connect(db)
-    cursor = conn.cursor()
-
-    cursor.execute("INSERT INTO anime (title, episodesWatched, totalEpisodes) VALUES (?, ?, ?)",
-                   (title, episodesWatched, totalEpisodes))
-    conn.commit()
-    conn.close() 
+    titleNorm = normalizeTitle(title)
+    with conn:
+        animeId = conn.execute(INSERT_ANIME, (title, episodesWatched, totalEpisodes, titleNorm)).lastrowid
+        indexTitle(conn, animeId, titleNorm)
     return f"Successfully added '{title}' to the database."
 
 @mcp.tool()
@@ -73,23 +263,66 @@ def updateAnimeProgress(title: str, episodesWatched: int):
     Tool to update the number of episodes watched for an anime.
     Only ever use this tool when the user asks so. If you want to use this tool ask the user
     Args:
-        title: title of the anime to update
+        title: title of the anime to update, or its id. The title does not need to be exact, "frieren" finds "Frieren: Beyond Journey's End"
         episodesWatched: the new number of episodes watched
     """
-    checkIfTableExists()
-    conn = sqlite3.connect(db)
-    cursor = conn.cursor()
-    
-    # Using parameterized query to prevent SQL injection
-    cursor.execute("UPDATE anime SET episodesWatched = ? WHERE title = ?", (episodesWatched, title))
-    conn.commit()
-    rows_affected = cursor.rowcount
-    conn.close()
-    
-    if rows_affected > 0:
-        return f"Successfully updated '{title}' to {episodesWatched} episodes watched."
-    else:
+    row, candidates = resolveAnime(title)
+    if row is None:
+        if candidates:
+            return formatCandidates(title, candidates)
         return f"No anime found with title '{title}'."
 
+    # Using parameterized query to prevent SQL injection
+    with conn:
+        conn.execute(UPDATE_PROGRESS_BY_ID, (episodesWatched, row[0]))
+    return f"Successfully updated '{row[1]}' to {episodesWatched} episodes watched."
+
+@mcp.tool()
+def upsertAnimeBatch(entries: List[AnimeEntry]) -> str:
+    """
+    Add or update many anime in one call, for example when importing a watch list.
+    Titles already in the database get their progress updated, new titles are added.
+    Args:
+        entries: list of anime, each with title, episodesWatched and optionally totalEpisodes
+    """
+    results = []
+    # One transaction for the whole batch instead of a commit per show
+    with conn:
+        for entry in entries:
+            if entry.episodesWatched < 0:
+                results.append(f"{entry.title}: skipped, episodesWatched cannot be negative")
+                continue
+            exists = conn.execute(SELECT_ID_BY_TITLE, (entry.title,)).fetchone() is not None
+            titleNorm = normalizeTitle(entry.title)
+            conn.execute(UPSERT_ANIME, (entry.title, entry.episodesWatched, entry.totalEpisodes, titleNorm))
+            if not exists:
+                indexTitle(conn, conn.execute(SELECT_ID_BY_TITLE, (entry.title,)).fetchone()[0], titleNorm)
+            action = "updated" if exists else "added"
+            results.append(f"{entry.title}: {action} ({entry.episodesWatched} episodes watched)")
+
+    return f"upsertAnimeBatch processed {len(entries)} entries:\n" + "\n".join(results)
+
+@mcp.tool()
+def updateAnimeProgressBatch(updates: List[AnimeProgress]) -> str:
+    """
+    Update the episodes watched for many anime in one call, for example after a binge session.
+    Only ever use this tool when the user asks so.
+    Args:
+        updates: list of anime, each with title (or id, approximate titles are fine) and the new episodesWatched
+    """
+    results = []
+    with conn:
+        for update in updates:
+            row, candidates = resolveAnime(update.title)
+            if row is not None:
+                conn.execute(UPDATE_PROGRESS_BY_ID, (update.episodesWatched, row[0]))
+                results.append(f"{row[1]}: updated to {update.episodesWatched} episodes watched")
+            elif candidates:
+                results.append(f"{update.title}: ambiguous, could be " + ", ".join(f"{r[1]} (id {r[0]})" for r in candidates))
+            else:
+                results.append(f"{update.title}: no anime found with this title")
+
+    return f"updateAnimeProgressBatch processed {len(updates)} entries:\n" + "\n".join(results)
+
 if __name__ == "__main__":
-    mcp.run(transport="stdio")
\ No newline at end of file
+    mcp.run(transport="stdio")
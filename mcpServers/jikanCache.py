@@ -0,0 +1,104 @@
+import json
+import os
+import sqlite3
+import sys
+import time
+
+DAY = 24 * 60 * 60
+
+defaultCacheDb = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "jikanCache.db")
+
+
+class FixtureJikan:
+    """Stand-in for the Jikan client that answers from a recorded fixture file, for offline testing"""
+
+    def __init__(self, fixturePath):
+        self.fixturePath = fixturePath
+        self.responses = {}
+        if fixturePath and os.path.exists(fixturePath):
+            with open(fixturePath, "r") as f:
+                self.responses = json.load(f)
+
+    def search(self, search_type, query, **kwargs):
+        return self.lookup(searchKey(search_type, query))
+
+    def anime(self, id, **kwargs):
+        return self.lookup(animeKey(id))
+
+    def lookup(self, key):
+        if key not in self.responses:
+            raise LookupError(f"No recorded Jikan response for {key}")
+        return self.responses[key]
+
+
+def searchKey(searchType, query):
+    return f"search:{searchType}:{' '.join(query.lower().split())}"
+
+
+def animeKey(malId):
+    return f"anime:{int(malId)}"
+
+
+class CachedJikan:
+    """On-disk SQLite cache of Jikan responses, together with the client to fill it
+
+    Finished shows rarely change, so they are kept for finishedTtl. Airing or upcoming
+    shows and search results expire sooner. Lookups go through AsyncJikan in
+    mcpServer.py, which serves expired entries if Jikan is unreachable. With
+    offline=True the network is never used and misses fall back to the fixture file.
+    """
+
+    def __init__(self, jikan=None, cachePath=None, offline=None, fixturePath=None,
+                 finishedTtl=None, airingTtl=None, searchTtl=None):
+        self.offline = offline if offline is not None else os.getenv("JIKAN_OFFLINE", "") == "1"
+        fixturePath = fixturePath or os.getenv("JIKAN_FIXTURES")
+        if self.offline:
+            self.jikan = FixtureJikan(fixturePath)
+        elif jikan is not None:
+            self.jikan = jikan
+        else:
+            from jikanpy import Jikan
+            self.jikan = Jikan()
+
+        self.finishedTtl = finishedTtl or float(os.getenv("JIKAN_FINISHED_TTL", str(30 * DAY)))
+        self.airingTtl = airingTtl or float(os.getenv("JIKAN_AIRING_TTL", str(DAY / 4)))
+        self.searchTtl = searchTtl or float(os.getenv("JIKAN_SEARCH_TTL", str(DAY)))
+
+        self.conn = sqlite3.connect(cachePath or os.getenv("JIKAN_CACHE_DB", defaultCacheDb), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS jikan_cache (key TEXT PRIMARY KEY, response TEXT NOT NULL, expiresAt REAL NOT NULL)")
+        self.conn.commit()
+
+    def animeTtl(self, response):
+        status = (response.get("data") or {}).get("status")
+        return self.finishedTtl if status == "Finished Airing" else self.airingTtl
+
+    def lookup(self, key):
+        """Return (response, fresh) for a cached key, or (None, False) on a miss"""
+        row = self.conn.execute("SELECT response, expiresAt FROM jikan_cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None, False
+        return json.loads(row[0]), row[1] > time.time() or self.offline
+
+    def store(self, key, response, ttl):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO jikan_cache (key, response, expiresAt) VALUES (?, ?, ?)",
+                (key, json.dumps(response), time.time() + ttl),
+            )
+
+    def exportFixtures(self, fixturePath):
+        """Write every cached response to a fixture file usable with JIKAN_OFFLINE=1"""
+        rows = self.conn.execute("SELECT key, response FROM jikan_cache").fetchall()
+        with open(fixturePath, "w") as f:
+            json.dump({key: json.loads(response) for key, response in rows}, f, indent=2)
+        return len(rows)
+
+
+if __name__ == "__main__":
+    # python jikanCache.py export fixtures.json
+    if len(sys.argv) == 3 and sys.argv[1] == "export":
+        count = CachedJikan(offline=True).exportFixtures(sys.argv[2])
+        print(f"Exported {count} cached responses to {sys.argv[2]}")
+    else:
+        print("Usage: python jikanCache.py export <fixtures.json>")
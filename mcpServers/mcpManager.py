@@ -1,7 +1,11 @@
 import json
 from mcp import StdioServerParameters
 
-def loadMCPConfig(configFilePath = "mcpConfig.json"):
+def loadMCPConfig(configFilePath = "mcpConfig.json", raiseErrors = False):
+    """Read the server definitions from the config file.
+    With raiseErrors the caller gets the exception instead of an empty config,
+    so a half-written file during a hot reload is not mistaken for "no servers"
+    """
     try:
         with open(configFilePath, "r") as f:
             config = json.load(f)
@@ -15,9 +19,13 @@ def loadMCPConfig(configFilePath = "mcpConfig.json"):
             )
         return mcpServers
     except FileNotFoundError:
+        if raiseErrors:
+            raise
         print(f"Config file '{configFilePath}' not found. Now using empty config")
         return{}    
     except json.JSONDecodeError as e:
+        if raiseErrors:
+            raise
         print(f"Error parsing config file: {e}")
         return{}
     
@@ -1,37 +1,149 @@
-from jikanpy import Jikan
+import asyncio
+import os
+import random
+import time
+from typing import Optional
 from mcp.server.fastmcp import FastMCP
 
+try:
+    from mcpServers.jikanCache import CachedJikan, searchKey, animeKey
+except ImportError:
+    from jikanCache import CachedJikan, searchKey, animeKey
+
+try:
+    from mcpServers.animeCatalog import AnimeCatalog
+except ImportError:
+    from animeCatalog import AnimeCatalog
+
 mcp = FastMCP("anime")
-jikan = Jikan()
+
+
+class TokenBucket:
+    """Allows `rate` requests per `per` seconds, making callers wait in line instead of failing"""
+
+    def __init__(self, rate, per):
+        self.capacity = rate
+        self.tokens = float(rate)
+        self.refillRate = rate / per
+        self.updatedAt = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updatedAt) * self.refillRate)
+                self.updatedAt = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.refillRate)
+
+
+class AsyncJikan:
+    """Async front for the cached Jikan client
+
+    Cache hits return straight away. Misses wait for both Jikan rate limits
+    (3 per second and 60 per minute by default), identical lookups already in
+    flight share one request, and 429 responses are retried with backoff.
+    """
+
+    def __init__(self, cache, perSecond=None, perMinute=None, maxRetries=4):
+        self.cache = cache
+        self.buckets = [
+            TokenBucket(perSecond or int(os.getenv("JIKAN_PER_SECOND", "3")), 1),
+            TokenBucket(perMinute or int(os.getenv("JIKAN_PER_MINUTE", "60")), 60),
+        ]
+        self.maxRetries = maxRetries
+        self.inflight = {}
+
+    async def search(self, searchType, query):
+        key = searchKey(searchType, query)
+        return await self.get(key, lambda: self.cache.jikan.search(searchType, query), lambda response: self.cache.searchTtl)
+
+    async def anime(self, id):
+        key = animeKey(id)
+        return await self.get(key, lambda: self.cache.jikan.anime(id=id), self.cache.animeTtl)
+
+    async def get(self, key, fetch, ttlFor):
+        response, fresh = self.cache.lookup(key)
+        if fresh:
+            return response
+
+        task = self.inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self.fetch(key, fetch, ttlFor, response))
+            self.inflight[key] = task
+            task.add_done_callback(lambda _: self.inflight.pop(key, None))
+        # Shielded so one caller giving up does not cancel the request for the others
+        return await asyncio.shield(task)
+
+    async def fetch(self, key, fetch, ttlFor, stale):
+        for attempt in range(self.maxRetries + 1):
+            if not self.cache.offline:
+                for bucket in self.buckets:
+                    await bucket.acquire()
+            try:
+                # jikanpy is blocking, keep it off the event loop
+                response = await asyncio.to_thread(fetch)
+            except Exception as e:
+                rateLimited = getattr(e, "status_code", None) == 429
+                if rateLimited and attempt < self.maxRetries:
+                    await asyncio.sleep(min(30, 2 ** attempt) + random.random())
+                    continue
+                # Stale data beats an error when Jikan is down or rate limiting us
+                if stale is not None:
+                    return stale
+                raise
+            self.cache.store(key, response, ttlFor(response))
+            return response
+
+
+# Cached on disk, see jikanCache.py for the TTL and offline settings
+jikan = AsyncJikan(CachedJikan())
+# Local dataset dump, filled with `python animeCatalog.py import <dump>`. Searches only go to Jikan when it has no match
+catalog = AnimeCatalog()
 
 
 @mcp.tool()
-def searchAnime(queryTitle: str) -> str:
+async def searchAnime(queryTitle: str, year: Optional[int] = None, animeType: Optional[str] = None) -> str:
     """Query search a title of an anime. Returns a list of anime that best fit the search term along with its respective mal_id
         When displaying the search result to the user, just list the anime title and not its mal_id
         Args:
             queryTitle: title of anime as search term
+            year: optional year the anime premiered, only set it if the user mentions one
+            animeType: optional type such as TV, Movie or OVA, only set it if the user mentions one
        """
     result = "searchAnime Tool used sucessfully and has returned the given information: \n"
+
+    matches = catalog.search(queryTitle, year=year, animeType=animeType)
+    if matches:
+        for x in matches:
+            title = x["title_english"] or x["title"]
+            result += ("title: "+title+ " ("+ (x["type"] or "")+", "+str(x["year"])+") mal_id: " + str(x["mal_id"]) + "\n" )
+        return(result)
     
-    anime = jikan.search("anime", queryTitle)
+    anime = await jikan.search("anime", queryTitle)
     for x in anime["data"]:
         if x["year"] == None:
-            year = x["aired"]["prop"]["from"]["year"]
+            airedYear = x["aired"]["prop"]["from"]["year"]
         else:
-            year = x["year"]
+            airedYear = x["year"]
         title = x["title"]
         if x["title_english"] != None:
             title = x["title_english"]
         if x["type"] is None:
-            animeType = ""
+            showType = ""
         else:
-            animeType = x["type"]
-        result += ("title: "+title+ " ("+ animeType+", "+str(year)+") mal_id: " + str(x["mal_id"]) + "\n" )
+            showType = x["type"]
+        # Jikan's search has no year or type filter of its own, so apply them here
+        if (year and airedYear != year) or (animeType and animeType.lower() != showType.lower()):
+            continue
+        result += ("title: "+title+ " ("+ showType+", "+str(airedYear)+") mal_id: " + str(x["mal_id"]) + "\n" )
     return(result)
     
 @mcp.tool()
-def getAnimeInfo(mal_id: int) -> str:
+async def getAnimeInfo(mal_id: int) -> str:
     """Search more info about an anime by using it's respective mal_id. 
         To get the anime's respective mal_id use searchAnime tool.
         This tool will return the anime's title, type, number of episodes, its score, when it premired, and synopsis
@@ -39,7 +151,7 @@ def getAnimeInfo(mal_id: int) -> str:
             mal_id: the anime's respective mal_id
     """
     info = "getAnimeInfo Tool used sucessfully and has returned the given information: \n"
-    anime = jikan.anime(id=mal_id)
+    anime = await jikan.anime(id=mal_id)
     anime = anime["data"]
     if anime["title_english"] != None:
         info+= ("Title: " + anime["title_english"]+"\n")
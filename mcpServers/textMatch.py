@@ -0,0 +1,37 @@
+import re
+import unicodedata
+
+
+def normalizeTitle(title):
+    """Fold a title to casefolded words so "Frieren: Beyond Journey's End" and "frieren beyond journeys end" compare equal
+
+    Accents on latin letters are dropped ("Pokémon" matches "pokemon"), while
+    other scripts such as Japanese are kept as they are.
+    """
+    if not title:
+        return ""
+    folded = []
+    for ch in unicodedata.normalize("NFKD", title):
+        if unicodedata.combining(ch) and folded and ord(folded[-1]) < 0x250:
+            continue
+        folded.append(ch)
+    title = unicodedata.normalize("NFC", "".join(folded)).casefold()
+    title = title.replace("'", "").replace("\u2019", "")
+    return " ".join(re.findall(r"[^\W_]+", title))
+
+
+def trigrams(normTitle):
+    """Trigrams of each word padded like pg_trgm does, so short words and word starts still count"""
+    grams = set()
+    for word in normTitle.split():
+        padded = "  " + word + " "
+        for i in range(len(padded) - 2):
+            grams.add(padded[i:i + 3])
+    return grams
+
+
+def similarity(queryGrams, titleGrams):
+    """Share of the query's trigrams found in the title, so "frieren" scores high against the full title"""
+    if not queryGrams:
+        return 0.0
+    return len(queryGrams & titleGrams) / len(queryGrams)
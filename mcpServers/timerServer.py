@@ -1,10 +1,170 @@
 import asyncio
-import json
+import heapq
+import math
 import os
+import sqlite3
+import sys
+import time
+from contextlib import asynccontextmanager
 
 from mcp.server.fastmcp import FastMCP
 
-mcp = FastMCP("timerServer")
+# promptIngest lives in the project root, one level above this script
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from promptIngest import submitPrompt, announcePrompt, announcePrompts, withdrawPrompt, PRIORITY_SCHEDULED
+
+defaultDb = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "timers.db")
+RETRY_DELAY = 5  # Seconds before retrying a prompt the chat server did not accept
+
+
+class TimerScheduler:
+    """Timers stored in SQLite with an in-memory min-heap of due times
+
+    A single task sleeps until the earliest due time, so any number of pending
+    timers costs one wakeup. Pending timers are re-armed on startup and the ones
+    that came due while the server was down fire straight away. Each timer is
+    announced to the chat server when it is armed, so the reply can be ready
+    by the time it fires.
+    """
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+CREATE TABLE IF NOT EXISTS timers (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    dueAt REAL NOT NULL,
+    prompt TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending'
+)""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_timers_pending ON timers(dueAt) WHERE status = 'pending'")
+        self.conn.commit()
+        self.heap = []
+        self.wakeup = None
+        self.task = None
+        self.announceTask = None
+
+    def start(self):
+        self.wakeup = asyncio.Event()
+        with self.conn:
+            interrupted = self.conn.execute("UPDATE timers SET status = 'fired' WHERE status = 'firing'").rowcount
+        if interrupted:
+            # Stopped between claiming and delivering: the prompt may already be in the journal, so don't send it again
+            print(f"{interrupted} timer(s) were interrupted while firing and are not re-sent", file=sys.stderr)
+        self.heap = [(dueAt, id) for id, dueAt in self.conn.execute("SELECT id, dueAt FROM timers WHERE status = 'pending'")]
+        heapq.heapify(self.heap)
+        self.task = asyncio.create_task(self.run())
+        self.announceTask = asyncio.create_task(self.announcePending())
+
+    async def stop(self):
+        tasks = [task for task in (self.task, self.announceTask) if task]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def announce(self, timerId, dueAt, prompt):
+        try:
+            await asyncio.to_thread(announcePrompt, timerKey(timerId), prompt, dueAt, PRIORITY_SCHEDULED, "timerServer")
+        except Exception as e:
+            # Only a missed head start, the prompt is still delivered when due
+            print(f"Failed to announce timer {timerId}: {e}", file=sys.stderr)
+
+    async def announcePending(self):
+        # The chat server may have restarted too, so re-announce everything still pending, in one batch
+        announcements = [(timerKey(timerId), prompt, dueAt) for timerId, dueAt, prompt in self.pending()]
+        try:
+            await asyncio.to_thread(announcePrompts, announcements, PRIORITY_SCHEDULED, "timerServer")
+        except Exception as e:
+            print(f"Failed to announce pending timers: {e}", file=sys.stderr)
+
+    def schedule(self, delaySeconds, prompt):
+        dueAt = time.time() + max(0, delaySeconds)
+        with self.conn:
+            timerId = self.conn.execute("INSERT INTO timers (dueAt, prompt) VALUES (?, ?)", (dueAt, prompt)).lastrowid
+        self.push(dueAt, timerId)
+        return timerId, dueAt
+
+    def push(self, dueAt, timerId):
+        heapq.heappush(self.heap, (dueAt, timerId))
+        # Only wake the loop if this timer is now the earliest one
+        if self.heap[0][1] == timerId and self.wakeup:
+            self.wakeup.set()
+
+    async def cancel(self, timerId):
+        # On the loop thread like every other use of the connection, it is one short UPDATE
+        with self.conn:
+            cancelled = self.conn.execute(
+                "UPDATE timers SET status = 'cancelled' WHERE id = ? AND status = 'pending'", (timerId,)
+            ).rowcount
+        # The heap entry is skipped when it comes due rather than searched for now
+        if cancelled:
+            try:
+                await asyncio.to_thread(withdrawPrompt, timerKey(timerId), "timerServer")
+            except Exception as e:
+                print(f"Failed to withdraw timer {timerId}: {e}", file=sys.stderr)
+        return cancelled > 0
+
+    def pending(self):
+        return self.conn.execute("SELECT id, dueAt, prompt FROM timers WHERE status = 'pending' ORDER BY dueAt").fetchall()
+
+    async def run(self):
+        while True:
+            self.wakeup.clear()
+            if not self.heap:
+                await self.wakeup.wait()
+                continue
+
+            delay = self.heap[0][0] - time.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            dueAt, timerId = heapq.heappop(self.heap)
+            await self.fire(dueAt, timerId)
+
+    async def fire(self, dueAt, timerId):
+        # Claimed before the prompt goes out, so a crash part way can't deliver it twice on restart
+        with self.conn:
+            row = self.conn.execute("SELECT prompt FROM timers WHERE id = ? AND status = 'pending'", (timerId,)).fetchone()
+            if row is None:
+                return  # Cancelled after it was armed
+            self.conn.execute("UPDATE timers SET status = 'firing' WHERE id = ?", (timerId,))
+
+        try:
+            await asyncio.to_thread(submitPrompt, row[0], PRIORITY_SCHEDULED, "timerServer", key=timerKey(timerId))
+        except Exception as e:
+            print(f"Failed to deliver timer {timerId}, retrying in {RETRY_DELAY}s: {e}", file=sys.stderr)
+            with self.conn:
+                self.conn.execute("UPDATE timers SET status = 'pending' WHERE id = ?", (timerId,))
+            self.push(time.time() + RETRY_DELAY, timerId)
+            return
+
+        with self.conn:
+            self.conn.execute("UPDATE timers SET status = 'fired' WHERE id = ?", (timerId,))
+        late = time.time() - dueAt
+        print(f"Timer {timerId} expired - prompt delivered to the chat server" + (f" ({late:.0f}s late)" if late > 1 else ""), file=sys.stderr)
+
+
+def timerKey(timerId):
+    return f"timer:{timerId}"
+
+
+scheduler = TimerScheduler(os.getenv("TIMER_DB", defaultDb))
+
+
+@asynccontextmanager
+async def lifespan(server):
+    scheduler.start()
+    try:
+        yield
+    finally:
+        await scheduler.stop()
+
+
+mcp = FastMCP("timerServer", lifespan=lifespan)
 
 @mcp.tool()
 async def scheduleMessage(delaySeconds: int, systemPrompt: str):
@@ -15,35 +175,34 @@ async def scheduleMessage(delaySeconds: int, systemPrompt: str):
       delaySeconds: Number of seconds to wait
       systemPrompt: The system message the chatbot should receive when time expires, should be like "remind the user to enjoy some anime"
     """
-    asyncio.create_task(backgroundTimer(delaySeconds, systemPrompt))
-    return(f"scheduleMessage tool executed successfully. Message scheduled in {delaySeconds} seconds")
+    timerId, dueAt = scheduler.schedule(delaySeconds, systemPrompt)
+    await scheduler.announce(timerId, dueAt, systemPrompt)
+    return(f"scheduleMessage tool executed successfully. Message scheduled in {delaySeconds} seconds with timer id {timerId}")
 
 
-async def backgroundTimer(delay, prompt):
-    await asyncio.sleep(delay)
-    filename= "pending_prompt.json"
-    try:
-        if os.path.exists(filename):
-            with open(filename, "r") as f:
-                data = json.load(f)
-                prompts_queue = data.get("prompts", [])
-        else:
-            prompts_queue = []
-        
-        # Add new prompt to the queue
-        prompts_queue.append({
-            "systemPrompt": prompt,
-            "timestamp": asyncio.get_event_loop().time()  # Optional: track when added
-        })
-        
-        # Write updated queue back to file
-        with open(filename, "w") as f:
-            json.dump({"prompts": prompts_queue}, f, indent=2)
-        
-        print(f"Timer expired - added prompt to {filename} (total: {len(prompts_queue)})")
-        
-    except Exception as e:
-        print(f"Failed to write prompt file: {e}")
+@mcp.tool()
+async def listTimers():
+    """
+    This tool lists the scheduled messages that have not fired yet, with their timer id and how long until they fire
+    """
+    timers = scheduler.pending()
+    if not timers:
+        return "There are no scheduled messages."
+    now = time.time()
+    lines = [f"id {id}: in {max(0, math.ceil(dueAt - now))} seconds - {prompt}" for id, dueAt, prompt in timers]
+    return "Scheduled messages:\n" + "\n".join(lines)
+
+
+@mcp.tool()
+async def cancelTimer(timerId: int):
+    """
+    This tool cancels a scheduled message. Use listTimers to find the timer id
+    Arguments:
+      timerId: id of the scheduled message to cancel
+    """
+    if await scheduler.cancel(timerId):
+        return f"Timer {timerId} cancelled."
+    return f"No pending timer with id {timerId}."
 
 if __name__ == "__main__":
-    mcp.run(transport="stdio")
\ No newline at end of file
+    mcp.run(transport="stdio")
@@ -0,0 +1,129 @@
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Seconds. Covers a fast websocket send up to a slow local LLM iteration
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+class Counter:
+    def __init__(self, name, help, labelNames=()):
+        self.name = name
+        self.help = help
+        self.labelNames = labelNames
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelNames)
+        # Everything is recorded from the event loop thread, so a plain dict update needs no lock
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for key, value in self.values.items():
+            lines.append(f"{self.name}{formatLabels(self.labelNames, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labelNames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelNames = labelNames
+        self.buckets = tuple(buckets)
+        self.series = {}
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelNames)
+        series = self.series.get(key)
+        if series is None:
+            # Per bucket counts (not cumulative) plus sum and count, cumulated only when scraped
+            series = self.series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total, count) in self.series.items():
+            cumulative = 0
+            for bound, bucketCount in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucketCount
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{formatLabels(self.labelNames + ('le',), key + (le,))} {cumulative}")
+            lines.append(f"{self.name}_sum{formatLabels(self.labelNames, key)} {total}")
+            lines.append(f"{self.name}_count{formatLabels(self.labelNames, key)} {count}")
+        return lines
+
+
+def formatLabels(names, values):
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help, labelNames=()):
+        metric = Counter(name, help, labelNames)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labelNames=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, help, labelNames, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Prometheus text exposition format"""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+llmLatency = registry.histogram(
+    "chatbot_llm_call_seconds", "LLM completion latency per tool-calling iteration", ("iteration",))
+toolLatency = registry.histogram(
+    "chatbot_tool_call_seconds", "Tool call latency", ("server", "tool"))
+approvalWait = registry.histogram(
+    "chatbot_approval_wait_seconds", "Time spent waiting for the user to approve or deny a tool call")
+ttsChunkLatency = registry.histogram(
+    "chatbot_tts_chunk_seconds", "Synthesis time of one TTS chunk")
+dbLatency = registry.histogram(
+    "chatbot_db_seconds", "Chat history database operation time", ("operation",),
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1))
+websocketSendLatency = registry.histogram(
+    "chatbot_websocket_send_seconds", "Time to send one websocket message", ("type",),
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1, 5))
+turnIterations = registry.histogram(
+    "chatbot_turn_iterations", "LLM iterations needed to finish one chat turn",
+    buckets=(1, 2, 3, 4, 5, 6, 7, 8, 9, 10))
+iterationsTotal = registry.counter(
+    "chatbot_iterations_total", "LLM iterations across all turns")
+maxIterationExhausted = registry.counter(
+    "chatbot_max_iterations_exhausted_total", "Turns that hit the iteration limit without a final reply")
+toolErrors = registry.counter(
+    "chatbot_tool_errors_total", "Tool calls that raised or returned an error", ("server", "tool"))
+websocketDropped = registry.counter(
+    "chatbot_websocket_dropped_total", "Outbound websocket messages shed because a client fell behind", ("type", "reason"))
+ttsCacheLookups = registry.counter(
+    "chatbot_tts_cache_lookups_total", "TTS audio cache lookups by result, hit rate is hits over all lookups", ("result",))
+ttsCacheEvictions = registry.counter(
+    "chatbot_tts_cache_evictions_total", "TTS audio cache entries evicted to stay under the byte budget")
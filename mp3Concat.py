@@ -0,0 +1,166 @@
+import struct
+
+# Index by [version][layer] for bitrates in kbps, where version 1 is MPEG-1 and 2 covers MPEG-2 and 2.5
+BITRATES = {
+    (1, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (1, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (1, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (2, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (2, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (2, 3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}  # By version bits
+VERSION_BITS = {3: "1", 2: "2", 0: "2.5"}
+
+
+class Mp3FormatError(ValueError):
+    """The chunks can't be joined frame by frame: not MP3, or encoded with different parameters"""
+
+
+def parseFrameHeader(data, offset):
+    """Return (frameLength, format) for a valid MPEG audio frame header at offset, or None"""
+    if offset + 4 > len(data):
+        return None
+    header = struct.unpack_from(">I", data, offset)[0]
+    if header >> 21 != 0x7FF:
+        return None
+    versionBits = (header >> 19) & 3
+    layerBits = (header >> 17) & 3
+    bitrateIndex = (header >> 12) & 15
+    sampleRateIndex = (header >> 10) & 3
+    if versionBits == 1 or layerBits == 0 or bitrateIndex in (0, 15) or sampleRateIndex == 3:
+        return None  # Reserved values, or free format which has no computable length
+
+    layer = 4 - layerBits
+    version = 1 if versionBits == 3 else 2
+    bitrate = BITRATES[(version, layer)][bitrateIndex] * 1000
+    sampleRate = SAMPLE_RATES[versionBits][sampleRateIndex]
+    padding = (header >> 9) & 1
+    channelMode = (header >> 6) & 3
+
+    if layer == 1:
+        length = (12 * bitrate // sampleRate + padding) * 4
+    elif layer == 3 and version == 2:
+        length = 72 * bitrate // sampleRate + padding
+    else:
+        length = 144 * bitrate // sampleRate + padding
+    return length, (VERSION_BITS[versionBits], layer, sampleRate, channelMode == 3)
+
+
+def audioBounds(data):
+    """Start and end of the audio frames, past any ID3v2 tag and before any ID3v1 or APEv2 tag"""
+    start = 0
+    while data[start:start + 3] == b"ID3" and len(data) >= start + 10:
+        size = 0
+        for byte in data[start + 6:start + 10]:
+            size = (size << 7) | (byte & 0x7F)  # Synchsafe integer
+        footer = 10 if data[start + 5] & 0x10 else 0
+        start += 10 + size + footer
+
+    end = len(data)
+    if end - start >= 128 and data[end - 128:end - 125] == b"TAG":
+        end -= 128
+    if end - start >= 32 and data[end - 32:end - 24] == b"APETAGEX":
+        size, flags = struct.unpack_from("<II", data, end - 20)
+        end -= size + (32 if flags & 0x80000000 else 0)
+    return start, max(start, end)
+
+
+def sideInfoSize(format):
+    version, layer, _, mono = format
+    if layer != 3:
+        return 0
+    if version == "1":
+        return 17 if mono else 32
+    return 9 if mono else 17
+
+
+def isVbrHeader(data, offset, format):
+    """Xing/Info or VBRI frames hold stats for their own file only, not audio"""
+    xing = offset + 4 + sideInfoSize(format)
+    return data[xing:xing + 4] in (b"Xing", b"Info") or data[offset + 36:offset + 40] == b"VBRI"
+
+
+def frameSpans(data):
+    """(start, end) of every audio frame in one MP3 buffer, plus the stream format"""
+    start, end = audioBounds(data)
+    spans = []
+    format = None
+    offset = start
+    while offset < end:
+        parsed = parseFrameHeader(data, offset)
+        if parsed is None or offset + parsed[0] > end:
+            offset += 1  # Junk between frames, look for the next sync word
+            continue
+        length, frameFormat = parsed
+        if format is None:
+            format = frameFormat
+            if isVbrHeader(data, offset, frameFormat):
+                offset += length
+                continue
+        elif frameFormat != format:
+            raise Mp3FormatError(f"Format changes mid-stream: {format} then {frameFormat}")
+        spans.append((offset, offset + length))
+        offset += length
+    if format is None:
+        raise Mp3FormatError("No MPEG audio frames found")
+    return spans, format
+
+
+def infoFrame(data, span, format, frameCount, byteCount):
+    """A fresh Xing frame for the joined stream, modelled on its first audio frame, or None if it won't fit"""
+    start, end = span
+    tagOffset = 4 + sideInfoSize(format)
+    if end - start < tagOffset + 16:
+        return None
+    frame = bytearray(end - start)
+    frame[:4] = data[start:start + 4]
+    # Flags 3: frame count (audio frames only) and byte count (whole stream) follow
+    frame[tagOffset:tagOffset + 16] = b"Xing" + struct.pack(">III", 3, frameCount, byteCount + len(frame))
+    return bytes(frame)
+
+
+def concatMp3(chunks, output):
+    """Join MP3 buffers into output (a path or binary file) by copying frames, with no decode or re-encode
+
+    Per-chunk ID3, APE and Xing/Info headers are dropped and one Xing header is
+    written for the whole stream. Raises Mp3FormatError if the chunks don't all
+    share the same MPEG version, layer, sample rate and channel count, so the
+    caller can fall back to transcoding.
+    """
+    parsed = [(data, *frameSpans(data)) for data in chunks]
+    if not parsed:
+        raise Mp3FormatError("Nothing to concatenate")
+    format = parsed[0][2]
+    for _, _, chunkFormat in parsed:
+        if chunkFormat != format:
+            raise Mp3FormatError(f"Chunks differ in format: {format} and {chunkFormat}")
+
+    frameCount = sum(len(spans) for _, spans, _ in parsed)
+    byteCount = sum(end - start for _, spans, _ in parsed for start, end in spans)
+    firstData, firstSpans, _ = parsed[0]
+    header = infoFrame(firstData, firstSpans[0], format, frameCount, byteCount) if firstSpans else None
+
+    if isinstance(output, (str, bytes)) or hasattr(output, "__fspath__"):
+        with open(output, "wb") as f:
+            writeFrames(f, parsed, header)
+    else:
+        writeFrames(output, parsed, header)
+    return frameCount
+
+
+def writeFrames(f, parsed, header):
+    if header:
+        f.write(header)
+    for data, spans, _ in parsed:
+        view = memoryview(data)
+        # Frames are usually back to back, so write each contiguous run in one go
+        runStart, runEnd = None, None
+        for start, end in spans:
+            if start != runEnd:
+                if runStart is not None:
+                    f.write(view[runStart:runEnd])
+                runStart = start
+            runEnd = end
+        if runStart is not None:
+            f.write(view[runStart:runEnd])
@@ -0,0 +1,148 @@
+import asyncio
+import heapq
+import itertools
+import os
+import time
+from contextlib import contextmanager
+
+PREGEN_LEAD_SECONDS = float(os.getenv("PREGEN_LEAD_SECONDS", "30"))
+# How many chat messages may be added after pre-generating before the reply is considered stale
+PREGEN_STALE_MESSAGES = int(os.getenv("PREGEN_STALE_MESSAGES", "0"))
+# How long after its due time an announced prompt that never arrived is forgotten
+PREGEN_EXPIRE_SECONDS = float(os.getenv("PREGEN_EXPIRE_SECONDS", "300"))
+
+
+class TurnTracker:
+    """Counts chat turns in progress so background work can wait for the model to be idle"""
+
+    def __init__(self):
+        self.active = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
+
+    @contextmanager
+    def track(self):
+        self.active += 1
+        self.idle.clear()
+        try:
+            yield
+        finally:
+            self.active -= 1
+            if self.active == 0:
+                self.idle.set()
+
+    async def waitIdle(self):
+        while self.active:
+            await self.idle.wait()
+
+
+class Pregenerator:
+    """Generates replies for prompts whose due time is announced in advance
+
+    Announced prompts sit in one min-heap driven by a single task, which only
+    wakes when the next one enters its lead window. Once no chat turn is
+    running, the reply is generated with generate(prompt) and held together
+    with the conversation version it was based on. When the prompt arrives it
+    is handed out straight away, unless the conversation has since moved on by
+    more than staleMessages, in which case the caller generates a fresh reply.
+    Entries whose prompt never arrives are dropped expireSeconds after they
+    were due.
+    """
+
+    def __init__(self, generate, turns, conversationVersion, leadSeconds=PREGEN_LEAD_SECONDS,
+                 staleMessages=PREGEN_STALE_MESSAGES, expireSeconds=PREGEN_EXPIRE_SECONDS):
+        self.generate = generate
+        self.turns = turns
+        self.conversationVersion = conversationVersion
+        self.leadSeconds = leadSeconds
+        self.staleMessages = staleMessages
+        self.expireSeconds = expireSeconds
+        self.entries = {}  # key -> {"prompt", "dueAt", "seq", "task", "version"}
+        self.heap = []  # (wakeAt, seq, action, key), stale items are skipped when popped
+        self.counter = itertools.count()
+        self.wakeup = None
+        self.task = None
+
+    def announce(self, key, prompt, dueAt):
+        self.withdraw(key)
+        seq = next(self.counter)
+        self.entries[key] = {"prompt": prompt, "dueAt": dueAt, "seq": seq, "task": None, "version": None}
+        self.push(dueAt - self.leadSeconds, seq, "prepare", key)
+        self.push(dueAt + self.expireSeconds, seq, "expire", key)
+
+    def withdraw(self, key):
+        entry = self.entries.pop(key, None)
+        if entry and entry["task"] and not entry["task"].done():
+            entry["task"].cancel()
+
+    def push(self, wakeAt, seq, action, key):
+        heapq.heappush(self.heap, (wakeAt, seq, action, key))
+        if self.task is None:
+            self.wakeup = asyncio.Event()
+            self.task = asyncio.create_task(self.run())
+        elif self.heap[0][1] == seq:
+            # Only wake the loop if this is now the earliest entry
+            self.wakeup.set()
+
+    async def run(self):
+        while True:
+            self.wakeup.clear()
+            if not self.heap:
+                await self.wakeup.wait()
+                continue
+
+            delay = self.heap[0][0] - time.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            _, seq, action, key = heapq.heappop(self.heap)
+            entry = self.entries.get(key)
+            if entry is None or entry["seq"] != seq:
+                continue  # Taken, withdrawn or re-announced since
+            # This is the only task driving the heap, so one bad entry must not take it down
+            try:
+                if action == "expire":
+                    self.withdraw(key)
+                    print(f"🗑️ Dropped pre-generated reply for {key}, its prompt never arrived")
+                else:
+                    await self.prepare(key, entry)
+            except Exception as e:
+                print(f"⚠️ Pre-generation failed for {key}: {e}")
+
+    async def prepare(self, key, entry):
+        await self.turns.waitIdle()
+        if self.entries.get(key) is not entry:
+            return  # Arrived or withdrawn while waiting for the model
+        entry["version"] = self.conversationVersion()
+        task = entry["task"] = asyncio.create_task(self.generate(entry["prompt"]))
+        # One generation at a time, the model is busy anyway
+        await asyncio.wait({task})
+        if task.cancelled():
+            return
+        if task.exception():
+            print(f"⚠️ Pre-generation failed for {key}: {task.exception()}")
+        else:
+            print(f"⏩ Pre-generated reply for {key}, due in {max(0, entry['dueAt'] - time.time()):.0f}s")
+
+    async def take(self, key, prompt):
+        """Return the pre-generated result for a prompt that just arrived, or None to generate it now"""
+        entry = self.entries.pop(key, None) if key else None
+        if entry is None or entry["prompt"] != prompt or entry["task"] is None:
+            return None  # Never got an idle moment, nothing to reuse
+
+        try:
+            # Already halfway there, finishing beats starting over
+            result = await asyncio.shield(entry["task"])
+        except Exception:
+            return None
+        if result is None:
+            return None
+        changed = self.conversationVersion() - entry["version"]
+        if changed < 0 or changed > self.staleMessages:
+            print(f"♻️ Conversation changed since {key} was pre-generated, regenerating")
+            return None
+        return result
@@ -0,0 +1,250 @@
+import asyncio
+import itertools
+import os
+import sys
+import time
+import urllib.request
+from promptJournal import PromptJournal
+
+# Lower runs first: a due reminder should not wait behind webcam small talk
+PRIORITY_SCHEDULED = 0
+PRIORITY_OBSERVATION = 1
+
+PROMPT_INGEST_URL = os.getenv("PROMPT_INGEST_URL", "http://127.0.0.1:8000/api/prompts")
+LOCAL_HOSTS = {"127.0.0.1", "::1", "localhost"}
+
+# How long to keep collecting after the first prompt of a burst, and how prompts are merged:
+#   "priority" - one turn per priority level, so reminders and webcam small talk stay separate
+#   "all"      - everything drained in the window becomes one turn
+#   "off"      - one turn per prompt
+COALESCE_WINDOW = float(os.getenv("PROMPT_COALESCE_WINDOW", "0.5"))
+COALESCE_MAX = int(os.getenv("PROMPT_COALESCE_MAX", "8"))
+COALESCE_MODE = os.getenv("PROMPT_COALESCE_MODE", "priority")
+# A prompt whose turn fails is retried with exponential backoff, then set aside in the dead-letter file
+PROMPT_MAX_ATTEMPTS = int(os.getenv("PROMPT_MAX_ATTEMPTS", "3"))
+PROMPT_RETRY_DELAY = float(os.getenv("PROMPT_RETRY_DELAY", "5"))
+
+
+class PromptQueue:
+    """In-process priority queue of developer prompts waiting for a chat turn, first in first out per priority"""
+
+    def __init__(self):
+        self.queue = asyncio.PriorityQueue()
+        self.counter = itertools.count()
+
+    def put(self, prompt, priority=PRIORITY_OBSERVATION, source="", offset=None, key=None, attempts=0):
+        self.queue.put_nowait((priority, next(self.counter), {"prompt": prompt, "priority": priority, "source": source,
+                                                              "offset": offset, "key": key, "attempts": attempts}))
+
+    async def get(self):
+        _, _, item = await self.queue.get()
+        return item
+
+    async def getBatch(self, window=COALESCE_WINDOW):
+        """Wait for a prompt, give the rest of a burst `window` seconds to arrive, then drain everything queued"""
+        items = [await self.get()]
+        if window > 0:
+            await asyncio.sleep(window)
+        while not self.queue.empty():
+            items.append(self.queue.get_nowait()[2])
+        items.sort(key=lambda item: item["priority"])  # Stable, so arrival order holds within a priority
+        return items
+
+    def empty(self):
+        return self.queue.empty()
+
+
+class PromptConsumer:
+    """The chat server's side of the prompt channel, shared by server.py and serverNoMCP.py
+
+    drain() moves records from the journal onto the queue whenever a producer
+    notifies us, and run() turns each drained batch into chat turns. Prompts
+    with a reply prepared ahead of time go to deliver(prompt, prepared), the
+    rest are coalesced and passed to handle(prompt). A prompt is only
+    acknowledged in the journal once its turn succeeded or it has been moved
+    to the dead-letter file after PROMPT_MAX_ATTEMPTS failures.
+    """
+
+    def __init__(self, handle, deliver, pregenerator, journal=None, queue=None):
+        self.handle = handle
+        self.deliver = deliver
+        self.pregenerator = pregenerator
+        self.journal = journal or PromptJournal()
+        self.queue = queue or PromptQueue()
+        self.wakeup = asyncio.Event()
+
+    def submit(self, prompt, priority=PRIORITY_OBSERVATION, source=""):
+        self.journal.append(journalRecord(prompt, priority, source))
+        self.wakeup.set()
+
+    def notify(self):
+        self.wakeup.set()
+
+    def start(self, tasks):
+        """Start the reader and the consumer, adding them to the caller's set of background tasks"""
+        for coroutine in (self.run(), self.drain()):
+            task = asyncio.create_task(coroutine)
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+    async def drain(self):
+        """Move prompts from the shared journal onto the ingest queue whenever a producer notifies us"""
+        while True:
+            try:
+                for endOffset, record in self.journal.readNew():
+                    self.ingest(endOffset, record)
+            except Exception as e:
+                print(f"⚠️ Error reading prompt journal: {e}")
+
+            # The timeout catches prompts whose producer could not reach us to notify
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=5)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+
+    def ingest(self, endOffset, record):
+        kind = record.get("kind", "prompt")
+        if kind == "upcoming":
+            # Not due yet: only a hint to prepare the reply, so there is nothing to replay after a restart
+            self.pregenerator.announce(record.get("key"), record.get("prompt"), record.get("dueAt", 0))
+            self.journal.acknowledge(endOffset)
+        elif kind == "withdrawn":
+            self.pregenerator.withdraw(record.get("key"))
+            self.journal.acknowledge(endOffset)
+        else:
+            self.queue.put(record.get("prompt"), record.get("priority", PRIORITY_OBSERVATION), record.get("source", ""),
+                           endOffset, record.get("key"))
+
+    async def run(self):
+        """Drain the ingest queue on every wakeup, coalescing bursts of prompts into as few chat turns as the policy allows"""
+        print("👀 Waiting for scheduled prompts...")
+        while True:
+            items = await self.queue.getBatch()
+            toGenerate = []
+            for item in items:
+                # Replies prepared ahead of time go out on their own rather than being coalesced
+                prepared = await self.pregenerator.take(item["key"], item["prompt"])
+                if prepared is None:
+                    toGenerate.append(item)
+                    continue
+                try:
+                    print(f"\n🕐 System Trigger (pre-generated): {item['prompt']}")
+                    await self.deliver(item["prompt"], prepared)
+                except Exception as e:
+                    print(f"⚠️ Error delivering scheduled prompt: {e}")
+                    self.retry([item], e)
+                else:
+                    self.journal.acknowledge(item["offset"])
+
+            for group in coalescePrompts(toGenerate):
+                prompt = combinePrompts([item["prompt"] for item in group])
+                try:
+                    print(f"\n🕐 System Trigger ({len(group)} prompt{'s' if len(group) > 1 else ''}): {prompt}")
+                    await self.handle(prompt)
+                except Exception as e:
+                    print(f"⚠️ Error handling scheduled prompt: {e}")
+                    self.retry(group, e)
+                else:
+                    for item in group:
+                        self.journal.acknowledge(item["offset"])
+
+    def retry(self, items, error):
+        """Queue failed prompts again after a backoff, or set them aside once they have used up their attempts"""
+        loop = asyncio.get_running_loop()
+        for item in items:
+            attempts = item["attempts"] + 1
+            if attempts < PROMPT_MAX_ATTEMPTS:
+                delay = PROMPT_RETRY_DELAY * 2 ** (attempts - 1)
+                print(f"🔁 Retrying prompt in {delay:.0f}s ({attempts}/{PROMPT_MAX_ATTEMPTS} attempts failed)")
+                # Still outstanding in the journal meanwhile, so a restart replays it
+                loop.call_later(delay, self.queue.put, item["prompt"], item["priority"], item["source"],
+                                item["offset"], item["key"], attempts)
+            else:
+                record = journalRecord(item["prompt"], item["priority"], item["source"], item["key"])
+                record.update(attempts=attempts, error=str(error))
+                self.journal.deadLetter(record)
+                print(f"☠️ Gave up on prompt after {attempts} attempts, moved to {self.journal.deadPath}")
+                self.journal.acknowledge(item["offset"])
+
+
+def coalescePrompts(items, mode=COALESCE_MODE, maxPrompts=COALESCE_MAX):
+    """Group drained queue items into turns according to the coalescing policy"""
+    if mode == "off":
+        return [[item] for item in items]
+
+    groups = []
+    for item in items:
+        last = groups[-1] if groups else None
+        if (last is None or len(last) >= maxPrompts
+                or (mode == "priority" and last[0]["priority"] != item["priority"])):
+            groups.append([item])
+        else:
+            last.append(item)
+    return groups
+
+
+def combinePrompts(prompts):
+    """Merge several developer prompts into one message so a burst costs a single generation"""
+    prompts = [prompt for prompt in prompts if prompt]
+    if len(prompts) <= 1:
+        return prompts[0] if prompts else ""
+    numbered = "\n".join(f"{i}. {prompt}" for i, prompt in enumerate(prompts, 1))
+    return f"Several things came up at once. Address all of them in a single reply:\n{numbered}"
+
+
+def journalRecord(prompt, priority=PRIORITY_OBSERVATION, source="", key=None, kind="prompt", dueAt=None):
+    """One journal line. kind is "prompt" for a prompt to run now, "upcoming" to announce one due
+    at dueAt so the reply can be prepared early, or "withdrawn" when an announced prompt is cancelled"""
+    record = {"prompt": prompt, "priority": priority, "source": source, "createdAt": time.time()}
+    if key:
+        record["key"] = key
+    if kind != "prompt":
+        record["kind"] = kind
+    if dueAt is not None:
+        record["dueAt"] = dueAt
+    return record
+
+
+def submitPrompt(prompt, priority=PRIORITY_OBSERVATION, source="", url=PROMPT_INGEST_URL, timeout=5, journal=None, key=None):
+    """Hand a developer prompt to the chat server. Used by the timer MCP server and the webcam observer
+
+    The prompt is appended to the shared journal first, so it survives the chat
+    server being down. The HTTP call only wakes the server up to read it.
+    """
+    (journal or PromptJournal()).append(journalRecord(prompt, priority, source, key))
+    notifyServer(url, timeout)
+
+
+def announcePrompt(key, prompt, dueAt, priority=PRIORITY_SCHEDULED, source="", url=PROMPT_INGEST_URL, timeout=5, journal=None):
+    """Tell the chat server a prompt is coming at dueAt, so it can generate the reply ahead of time
+
+    The prompt must still be submitted with the same key when it is due.
+    """
+    (journal or PromptJournal()).append(journalRecord(prompt, priority, source, key, "upcoming", dueAt))
+    notifyServer(url, timeout)
+
+
+def announcePrompts(announcements, priority=PRIORITY_SCHEDULED, source="", url=PROMPT_INGEST_URL, timeout=5, journal=None):
+    """announcePrompt for many (key, prompt, dueAt) at once, with one journal write and one notify"""
+    records = [journalRecord(prompt, priority, source, key, "upcoming", dueAt) for key, prompt, dueAt in announcements]
+    if not records:
+        return
+    (journal or PromptJournal()).appendAll(records)
+    notifyServer(url, timeout)
+
+
+def withdrawPrompt(key, source="", url=PROMPT_INGEST_URL, timeout=5, journal=None):
+    (journal or PromptJournal()).append(journalRecord("", PRIORITY_SCHEDULED, source, key, "withdrawn"))
+    notifyServer(url, timeout)
+
+
+def notifyServer(url=PROMPT_INGEST_URL, timeout=5):
+    try:
+        request = urllib.request.Request(url + "/notify", data=b"", method="POST")
+        with urllib.request.urlopen(request, timeout=timeout):
+            pass
+    except OSError as e:
+        # Picked up by the server's periodic journal check or on its next start
+        # stderr, since stdout is the protocol channel when called from an MCP server
+        print(f"Prompt journaled, chat server not notified: {e}", file=sys.stderr)
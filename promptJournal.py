@@ -0,0 +1,143 @@
+import json
+import os
+
+try:
+    import fcntl
+except ImportError:  # Windows: O_APPEND single writes are still appended whole, just without the lock
+    fcntl = None
+
+defaultJournal = os.path.join(os.path.dirname(os.path.abspath(__file__)), "prompts.journal")
+COMPACT_BYTES = 256 * 1024
+
+
+class PromptJournal:
+    """Append-only JSON lines journal of developer prompts shared by producers and the chat server
+
+    Producers append one line per prompt with a single O_APPEND write under an
+    exclusive lock, so concurrent writers never lose each other's prompts and an
+    enqueue costs O(1). The consumer remembers how far it has handled in a
+    separate offset file and compacts the journal once enough of it is consumed.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or os.getenv("PROMPT_JOURNAL", defaultJournal)
+        self.offsetPath = self.path + ".offset"
+        self.deadPath = self.path + ".dead"  # Prompts that kept failing, kept for a human to look at
+        self.base = 0
+        self.inode = None  # Journal file the base refers to, to spot a compaction the state file missed
+        self.readOffset = None
+        self.outstanding = {}  # end offset -> start offset of entries read but not yet acknowledged
+
+    # Producer side
+
+    def append(self, record):
+        self.appendAll([record])
+
+    def appendAll(self, records):
+        """Append several records in one write, so they land together and in order"""
+        line = "".join(json.dumps(record) + "\n" for record in records).encode("utf-8")
+        while True:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                lock(fd)
+                # Compaction swaps the file out, so make sure we still hold the live one
+                if fcntl is None or os.fstat(fd).st_ino == os.stat(self.path).st_ino:
+                    os.write(fd, line)
+                    return
+            finally:
+                os.close(fd)
+
+    # Consumer side
+    # Offsets handed out are logical: they keep counting across compactions,
+    # with base being the logical offset of the first byte still in the file
+
+    def loadState(self):
+        try:
+            with open(self.offsetPath, "r") as f:
+                state = json.load(f)
+            base, committed, inode = state["base"], state["committed"], state.get("inode")
+        except (FileNotFoundError, ValueError, KeyError):
+            return 0, 0
+        try:
+            current = os.stat(self.path).st_ino
+        except FileNotFoundError:
+            current = None
+        if inode is not None and current != inode:
+            # Compacted, or removed, after the state was written: the file now starts at committed
+            print("⚠️ Prompt journal was replaced since the offsets were saved, rebasing")
+            base = committed
+        self.inode = current
+        return base, committed
+
+    def saveState(self, committed):
+        writeAtomic(self.offsetPath, json.dumps({"base": self.base, "committed": committed, "inode": self.inode}))
+
+    def readNew(self):
+        """Return [(endOffset, record)] for complete lines past what has been read so far"""
+        if self.readOffset is None:
+            self.base, self.readOffset = self.loadState()
+        try:
+            with open(self.path, "rb") as f:
+                if self.inode is None:
+                    self.inode = os.fstat(f.fileno()).st_ino  # Created by a producer after we started
+                f.seek(self.readOffset - self.base)
+                data = f.read()
+        except FileNotFoundError:
+            return []
+
+        entries = []
+        start = self.readOffset
+        # A producer may be mid-write, so only take lines that end with a newline
+        for raw in data.splitlines(keepends=True):
+            if not raw.endswith(b"\n"):
+                break
+            end = start + len(raw)
+            try:
+                entries.append((end, json.loads(raw)))
+                self.outstanding[end] = start
+            except json.JSONDecodeError:
+                print(f"⚠️ Skipping unreadable prompt journal line at offset {start}")
+            start = end
+        self.readOffset = start
+        return entries
+
+    def acknowledge(self, endOffset):
+        """Mark an entry handled and move the committed offset past every handled entry before it"""
+        self.outstanding.pop(endOffset, None)
+        committed = min(self.outstanding.values()) if self.outstanding else self.readOffset
+        self.saveState(committed)
+        if committed - self.base >= COMPACT_BYTES:
+            self.compact(committed)
+
+    def deadLetter(self, record):
+        with open(self.deadPath, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record) + "\n")
+
+    def compact(self, committed):
+        """Drop the consumed prefix of the journal, holding the lock so no append lands in the old file"""
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            lock(fd)
+            with open(self.path, "rb") as f:
+                f.seek(committed - self.base)
+                rest = f.read()
+            # Journal first, then the state naming the new file: after a crash in between,
+            # loadState sees the inode no longer matches and rebases onto the committed offset
+            writeAtomic(self.path, rest, binary=True)
+            self.base = committed
+            self.inode = os.stat(self.path).st_ino
+            self.saveState(committed)
+        finally:
+            os.close(fd)
+
+
+def lock(fd):
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_EX)  # Released when the fd is closed
+
+
+def writeAtomic(path, content, binary=False):
+    tempPath = path + ".tmp"
+    with open(tempPath, "wb" if binary else "w") as f:
+        f.write(content)
+    os.replace(tempPath, path)
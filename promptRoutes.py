@@ -0,0 +1,37 @@
+from typing import Optional
+
+from fastapi import APIRouter, HTTPException, Request
+from pydantic import BaseModel
+
+from promptIngest import PRIORITY_OBSERVATION, LOCAL_HOSTS
+
+
+class PromptSubmission(BaseModel):
+    prompt: str
+    priority: int = PRIORITY_OBSERVATION
+    source: Optional[str] = ""
+
+
+def promptRouter(consumer):
+    """The /api/prompts endpoints, feeding the given PromptConsumer"""
+    router = APIRouter()
+
+    def requireLocal(request: Request):
+        if request.client is None or request.client.host not in LOCAL_HOSTS:
+            raise HTTPException(status_code=403, detail="Prompts can only be submitted from this machine")
+
+    @router.post("/api/prompts")
+    async def submit_prompt(submission: PromptSubmission, request: Request):
+        """Ingest channel for the timer MCP server and the webcam observer, local callers only"""
+        requireLocal(request)
+        consumer.submit(submission.prompt, submission.priority, submission.source)
+        return {"status": "queued"}
+
+    @router.post("/api/prompts/notify")
+    async def notify_prompts(request: Request):
+        """Producers that appended to the prompt journal themselves call this to wake the reader"""
+        requireLocal(request)
+        consumer.notify()
+        return {"status": "ok"}
+
+    return router
@@ -1,9 +1,9 @@
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, PlainTextResponse
 from pydantic import BaseModel
-from openai import OpenAI
+from openai import AsyncOpenAI
 import json
 from mcp.client.session import ClientSession
 from mcp.client.stdio import stdio_client
@@ -11,6 +11,13 @@ import asyncio
 from typing import Optional, Dict, Any
 from chatMessage import ChatMessage
 from mcpServers.mcpManager import loadMCPConfig, mcpToolToOpenAIFormat
+from toolResults import ToolResultStore, fetchMoreTool, FETCH_MORE_TOOL_NAME
+from toolSelector import ToolSelector
+import metrics
+from promptIngest import PromptConsumer
+from promptRoutes import promptRouter
+from pregen import Pregenerator, TurnTracker
+from broadcastHub import BroadcastHub
 from watchfiles import awatch
 import os
 from dotenv import load_dotenv
@@ -27,15 +34,30 @@ app.add_middleware(
 )
 
 # Initialize OpenAI client and database
-client = OpenAI(api_key="none", base_url="http://localhost:5001/v1")
+# Async, so a turn (or a background pre-generation) never blocks the event loop while the model runs
+client = AsyncOpenAI(api_key="none", base_url="http://localhost:5001/v1")
 db = ChatMessage("chatMemory.db")
+toolResults = ToolResultStore()
+toolSelector = ToolSelector()
+hub = BroadcastHub()
+chat_turns = TurnTracker()
+pregenerator = Pregenerator(
+    lambda prompt: process_chat(prompt, "developer", False, None, None, save_reply=False), chat_turns, db.latestId)
+prompt_consumer = PromptConsumer(
+    lambda prompt: handle_scheduled_prompt(prompt), lambda prompt, prepared: deliver_scheduled_reply(prompt, prepared), pregenerator)
+app.include_router(promptRouter(prompt_consumer))
 
 # Global storage for MCP sessions and tools
+MCP_CONFIG_PATH = "mcpServers/mcpConfig.json"
 mcp_sessions: Dict[str, ClientSession] = {}
 mcp_tools: Dict[str, list] = {}
+mcp_server_params: Dict[str, Any] = {}  # Config each running server was started with
+mcp_server_tasks: Dict[str, asyncio.Task] = {}
+mcp_stop_events: Dict[str, asyncio.Event] = {}
+mcp_inflight_calls: Dict[str, int] = {}  # Tool calls currently running per server, used to drain
+mcp_reload_lock = asyncio.Lock()
 pending_approvals: Dict[str, asyncio.Queue] = {}
 background_tasks = set()
-active_websockets: set = set()  # Track all active WebSocket connections
 
 
 class ChatRequest(BaseModel):
@@ -47,8 +69,8 @@ class ToolApprovalResponse(BaseModel):
     reason: Optional[str] = ""
 
 
-async def maintain_mcp_connection(serverName: str, serverParams: dict):
-    """Maintain a persistent connection to an MCP server"""
+async def maintain_mcp_connection(serverName: str, serverParams: dict, stopEvent: asyncio.Event):
+    """Maintain a persistent connection to an MCP server until stopEvent is set"""
     try:
         print(f"Connecting to {serverName}...")
         async with stdio_client(serverParams) as (read, write):
@@ -58,47 +80,155 @@ async def maintain_mcp_connection(serverName: str, serverParams: dict):
                 serverTools = await session.list_tools()
                 mcp_sessions[serverName] = session
                 mcp_tools[serverName] = serverTools.tools
+                toolSelector.addServer(serverName, [mcpToolToOpenAIFormat(tool, serverName) for tool in serverTools.tools])
                 
                 print(f"✅ {serverName}: {len(serverTools.tools)} tools available")
                 for tool in serverTools.tools:
                     print(f"   - {tool.name}: {tool.description}")
                 
-                # Keep the connection alive indefinitely
-                while True:
-                    await asyncio.sleep(1)
+                # Keep the connection alive until the server is stopped or reloaded
+                await stopEvent.wait()
+                print(f"🔌 {serverName} stopped")
                     
     except Exception as e:
         print(f"❌ Failed to connect to {serverName}: {e}")
-        # Remove from sessions if connection fails
+    finally:
+        # Remove from sessions once the connection is gone
         if serverName in mcp_sessions:
             del mcp_sessions[serverName]
         if serverName in mcp_tools:
             del mcp_tools[serverName]
+        toolSelector.removeServer(serverName)
+
+
+def start_mcp_server(serverName: str, serverParams):
+    """Spawn a background connection to one MCP server"""
+    stopEvent = asyncio.Event()
+    task = asyncio.create_task(maintain_mcp_connection(serverName, serverParams, stopEvent))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+    mcp_server_params[serverName] = serverParams
+    mcp_server_tasks[serverName] = task
+    mcp_stop_events[serverName] = stopEvent
+
+
+async def stop_mcp_server(serverName: str, drainTimeout: float = 30):
+    """Stop routing new calls to a server, wait for its running calls to finish, then shut it down"""
+    mcp_server_params.pop(serverName, None)
+    task = mcp_server_tasks.pop(serverName, None)
+    stopEvent = mcp_stop_events.pop(serverName, None)
+
+    # New tool calls see the server as gone straight away
+    mcp_sessions.pop(serverName, None)
+    mcp_tools.pop(serverName, None)
+    toolSelector.removeServer(serverName)
+
+    waited = 0.0
+    while mcp_inflight_calls.get(serverName, 0) > 0 and waited < drainTimeout:
+        await asyncio.sleep(0.1)
+        waited += 0.1
+    if mcp_inflight_calls.get(serverName, 0) > 0:
+        print(f"⚠️ {serverName} still has running tool calls after {drainTimeout}s, stopping anyway")
+
+    if stopEvent:
+        stopEvent.set()
+    if task:
+        try:
+            await asyncio.wait_for(task, timeout=10)
+        except asyncio.TimeoutError:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+
+def mcp_params_changed(oldParams, newParams) -> bool:
+    return (
+        oldParams.command != newParams.command
+        or list(oldParams.args) != list(newParams.args)
+        or (oldParams.env or {}) != (newParams.env or {})
+    )
+
+
+async def mcp_server_dead(serverName: str) -> bool:
+    """True once a server's connection task has ended or its session stops answering pings"""
+    task = mcp_server_tasks.get(serverName)
+    if task is None or task.done():
+        return True
+    session = mcp_sessions.get(serverName)
+    if session is None:
+        return False  # Still connecting
+    try:
+        await asyncio.wait_for(session.send_ping(), timeout=5)
+    except Exception:
+        return True
+    return False
+
+
+async def reload_mcp_servers():
+    """Diff mcpConfig.json against the running servers and only touch the ones that changed or died"""
+    async with mcp_reload_lock:
+        try:
+            newServers = loadMCPConfig(MCP_CONFIG_PATH, raiseErrors=True)
+        except (FileNotFoundError, json.JSONDecodeError, KeyError) as e:
+            print(f"⚠️ Ignoring mcpConfig.json change, keeping the running servers: {e}")
+            return
+
+        removed = [name for name in mcp_server_params if name not in newServers]
+        added = [name for name in newServers if name not in mcp_server_params]
+        changed = [
+            name for name in newServers
+            if name in mcp_server_params and mcp_params_changed(mcp_server_params[name], newServers[name])
+        ]
+        # A server that crashed keeps its params, so it would otherwise never be started again
+        kept = [name for name in newServers if name in mcp_server_params and name not in changed]
+        deadFlags = await asyncio.gather(*(mcp_server_dead(name) for name in kept))
+        dead = [name for name, isDead in zip(kept, deadFlags) if isDead]
+
+        if not (removed or added or changed or dead):
+            return
+        print(f"🔄 Reloading MCP servers: added {added}, removed {removed}, restarted {changed}, revived {dead}")
+
+        await asyncio.gather(*(stop_mcp_server(name) for name in removed + changed + dead))
+        for name in added + changed + dead:
+            start_mcp_server(name, newServers[name])
+
+
+async def watch_mcp_config():
+    """Hot reload MCP servers whenever mcpConfig.json is edited"""
+    configDir = os.path.dirname(MCP_CONFIG_PATH)
+    configName = os.path.basename(MCP_CONFIG_PATH)
+    try:
+        # Watch the folder rather than the file so editors that save by renaming still trigger
+        async for _ in awatch(configDir, watch_filter=lambda change, path: os.path.basename(path) == configName):
+            await reload_mcp_servers()
+    except Exception as e:
+        print(f"❌ Error in MCP config watcher: {e}")
 
 
 async def initialize_mcp_servers():
     """Initialize all MCP servers on startup"""
-    mcpServers = loadMCPConfig("mcpServers/mcpConfig.json")
+    mcpServers = loadMCPConfig(MCP_CONFIG_PATH)
     
     if not mcpServers:
         print("⚠️ No MCP servers configured")
-        return
-    
-    print("🔌 Connecting to MCP servers...\n")
+    else:
+        print("🔌 Connecting to MCP servers...\n")
     
     # Create background tasks for each server connection
     for serverName, serverParams in mcpServers.items():
-        task = asyncio.create_task(maintain_mcp_connection(serverName, serverParams))
-        background_tasks.add(task)
-        task.add_done_callback(background_tasks.discard)
+        start_mcp_server(serverName, serverParams)
     
     # Give servers time to connect
-    await asyncio.sleep(2)
-    
-    # Start watching for scheduled prompts
-    task = asyncio.create_task(watch_for_scheduled_prompts())
+    if mcpServers:
+        await asyncio.sleep(2)
+
+    # Pick up later edits to the config without a restart
+    task = asyncio.create_task(watch_mcp_config())
     background_tasks.add(task)
     task.add_done_callback(background_tasks.discard)
+    
+    # Start watching for scheduled prompts
+    prompt_consumer.start(background_tasks)
 
 
 @app.on_event("startup")
@@ -107,46 +237,14 @@ async def startup_event():
     await initialize_mcp_servers()
 
 
-async def watch_for_scheduled_prompts():
-    """Watch for pending_prompt.json creation and trigger chatbot"""
-    print("👀 Watching for scheduled prompts...")
-    try:
-        async for changes in awatch(".", debounce=200):
-            for _, path in changes:  # use _ to ignore the change type
-                if os.path.basename(path) == "pending_prompt.json":
-                    try:
-                        await asyncio.sleep(0.05)  # small delay to ensure file is written
-                        with open(path, "r") as f:
-                            data = json.load(f)
-                            prompts_queue = data.get("prompts", [])
-                            system_prompt = prompts_queue[0]["developerPrompt"] if prompts_queue else None
-                        
-                        if system_prompt == None:
-                            continue
-
-                        print(f"\n🕐 System Trigger: {system_prompt}")
-                        
-                        # Clear the file
-                        with open(path, "w") as f:
-                            prompts_queue = prompts_queue[1:]
-                            json.dump({"prompts": prompts_queue}, f)
-                       
-                        # Handle the scheduled prompt
-                        await handle_scheduled_prompt(system_prompt)
-                        
-                    except Exception as e:
-                        print(f"⚠️ Error handling scheduled prompt: {e}")
-    except Exception as e:
-        print(f"❌ Error in scheduled prompt watcher: {e}")
-
-
 async def handle_scheduled_prompt(prompt: str):
     """Process a scheduled prompt and broadcast to all connected clients"""
     if not prompt:
         return
     
     # Process using the shared chat function (no approval needed, pass None for websocket)
-    response = await process_chat(prompt, "developer",False,None, None, auto_approve=False)
+    with chat_turns.track():
+        response = await process_chat(prompt, "developer",False,None, None, auto_approve=False)
     
     # Broadcast to all connected clients
     await broadcast_scheduled_message(prompt, response)
@@ -155,6 +253,13 @@ async def handle_scheduled_prompt(prompt: str):
     return response
 
 
+async def deliver_scheduled_reply(prompt: str, reply: str):
+    """Send a reply generated ahead of time, recording it in the history only now that it is due"""
+    db.saveMessage("assistant", reply)
+    await broadcast_scheduled_message(prompt, reply)
+    print(f"\nAssistant: {reply}\n")
+
+
 async def broadcast_scheduled_message(system_prompt: str, response: str):
     """Broadcast scheduled message to all connected WebSocket clients"""
     message_data = {
@@ -163,24 +268,17 @@ async def broadcast_scheduled_message(system_prompt: str, response: str):
         "response": response
     }
     
-    # Send to all connected clients
-    disconnected = set()
-    for ws in active_websockets:
-        try:
-            await ws.send_json(message_data)
-        except Exception as e:
-            print(f"Failed to send to client: {e}")
-            disconnected.add(ws)
-    
-    # Remove disconnected clients
-    active_websockets.difference_update(disconnected)
+    # Serialized once and queued per client, so a slow client cannot hold up the rest
+    hub.broadcast(message_data)
 
 
 @app.on_event("shutdown")
 async def shutdown_event():
     """Cleanup on shutdown"""
     print("Shutting down MCP connections...")
-    for task in background_tasks:
+    for stopEvent in mcp_stop_events.values():
+        stopEvent.set()
+    for task in list(background_tasks):
         task.cancel()
 
 
@@ -197,6 +295,12 @@ async def get_history():
     return {"messages": messages}
 
 
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus scrape endpoint"""
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
+
+
 @app.post("/api/clear-history")
 async def clear_history():
     """Clear chat history"""
@@ -211,8 +315,7 @@ async def websocket_endpoint(websocket: WebSocket):
     connection_id = id(websocket)
     pending_approvals[connection_id] = {}
     
-    # Add to active websockets
-    active_websockets.add(websocket)
+    hub.register(websocket)
     
     # Queue for chat requests
     chat_queue = asyncio.Queue()
@@ -259,10 +362,11 @@ async def websocket_endpoint(websocket: WebSocket):
                 
                 
                 # Process chat with tool calls
-                response = await process_chat(user_message, "user", True,websocket, connection_id)
+                with chat_turns.track():
+                    response = await process_chat(user_message, "user", True,websocket, connection_id)
                 
                 # Send final response
-                await websocket.send_json({
+                hub.send(websocket, {
                     "type": "message",
                     "role": "assistant",
                     "content": response
@@ -288,8 +392,7 @@ async def websocket_endpoint(websocket: WebSocket):
         receiver_task.cancel()
         processor_task.cancel()
         
-        # Remove from active websockets
-        active_websockets.discard(websocket)
+        await hub.unregister(websocket)
         
         if connection_id in pending_approvals:
             del pending_approvals[connection_id]
@@ -299,13 +402,14 @@ async def websocket_endpoint(websocket: WebSocket):
             pass
 
 
-async def process_chat(message: str, role: str, tools: bool, websocket: Optional[WebSocket], connection_id: Optional[int], auto_approve: bool = False):
+async def process_chat(message: str, role: str, tools: bool, websocket: Optional[WebSocket], connection_id: Optional[int], auto_approve: bool = False, save_reply: bool = True):
     """Process chat with tool call handling
     
     Args:
         websocket: WebSocket connection for user approval (None for auto-approve)
         connection_id: Connection ID for tracking approvals (None for auto-approve)
         auto_approve: If True, automatically approve all tool calls without user interaction
+        save_reply: If False, the reply is returned without being saved to the history
     """
     
     systemPrompt = (
@@ -327,11 +431,12 @@ async def process_chat(message: str, role: str, tools: bool, websocket: Optional
         db.saveMessage(role, message)
         messages.append({"role": role, "content": message})
 
-    # Prepare OpenAI tools
+    # Prepare OpenAI tools, only sending the ones relevant to this turn
     openAITools = []
     if tools and mcp_tools:  # Only prepare tools if tools=True
-        for serverName, tools_list in mcp_tools.items():
-            openAITools.extend([mcpToolToOpenAIFormat(tool, serverName) for tool in tools_list])
+        recentContext = [m["content"] for m in (history or [])[-4:] if m["role"] == "user"]
+        openAITools = toolSelector.select(message, recentContext)
+        openAITools.append(fetchMoreTool)
     
     maxIteration = 10
     iteration = 0
@@ -350,14 +455,18 @@ async def process_chat(message: str, role: str, tools: bool, websocket: Optional
             api_params["tools"] = openAITools
             api_params["tool_choice"] = "auto"
         
-        response = client.chat.completions.create(**api_params)
+        metrics.iterationsTotal.inc()
+        with metrics.llmLatency.time(iteration=iteration):
+            response = await client.chat.completions.create(**api_params)
         
         message = response.choices[0].message
         
         # No tool calls - return response
         if not message.tool_calls:
             reply = message.content
-            db.saveMessage("assistant", reply)
+            if save_reply:
+                db.saveMessage("assistant", reply)
+            metrics.turnIterations.observe(iteration)
             return reply
         
         # If we get here, there are tool calls
@@ -365,7 +474,9 @@ async def process_chat(message: str, role: str, tools: bool, websocket: Optional
         if not tools:
             # Tool calls came back but tools are disabled - just return the text content
             reply = message.content or "I cannot use tools right now."
-            db.saveMessage("assistant", reply)
+            if save_reply:
+                db.saveMessage("assistant", reply)
+            metrics.turnIterations.observe(iteration)
             return reply
         
         # Add assistant message with tool calls
@@ -388,6 +499,15 @@ async def process_chat(message: str, role: str, tools: bool, websocket: Optional
         for toolCall in message.tool_calls:
             fullToolName = toolCall.function.name
             toolArgs = json.loads(toolCall.function.arguments)
+
+            # Paging through an earlier oversized result never needs approval
+            if fullToolName == FETCH_MORE_TOOL_NAME:
+                messages.append({
+                    "role": "tool",
+                    "tool_call_id": toolCall.id,
+                    "content": toolResults.fetchMore(toolArgs.get("handle", ""))
+                })
+                continue
             
             # Parse server and tool name
             if ":" in fullToolName:
@@ -415,7 +535,7 @@ async def process_chat(message: str, role: str, tools: bool, websocket: Optional
                     pending_approvals[connection_id][toolCall.id] = asyncio.Queue()
                     
                     # Request approval from user
-                    await websocket.send_json({
+                    hub.send(websocket, {
                         "type": "tool_call_request",
                         "tool_name": fullToolName,
                         "arguments": toolArgs,
@@ -423,7 +543,8 @@ async def process_chat(message: str, role: str, tools: bool, websocket: Optional
                     })
                     
                     # Wait for approval
-                    approval_response = await pending_approvals[connection_id][toolCall.id].get()
+                    with metrics.approvalWait.time():
+                        approval_response = await pending_approvals[connection_id][toolCall.id].get()
                     approved = approval_response.get("approved", False)
                     reason = approval_response.get("reason", "")
                     
@@ -433,7 +554,7 @@ async def process_chat(message: str, role: str, tools: bool, websocket: Optional
             if approved:
                 # Execute tool
                 if websocket and not auto_approve:
-                    await websocket.send_json({
+                    hub.send(websocket, {
                         "type": "tool_executing",
                         "tool_name": fullToolName,
                         "tool_call_id": toolCall.id
@@ -442,7 +563,12 @@ async def process_chat(message: str, role: str, tools: bool, websocket: Optional
                 try:
                     if serverName and serverName in mcp_sessions:
                         session = mcp_sessions[serverName]
-                        result = await session.call_tool(toolName, toolArgs)
+                        mcp_inflight_calls[serverName] = mcp_inflight_calls.get(serverName, 0) + 1
+                        try:
+                            with metrics.toolLatency.time(server=serverName, tool=toolName):
+                                result = await session.call_tool(toolName, toolArgs)
+                        finally:
+                            mcp_inflight_calls[serverName] -= 1
                         
                         if hasattr(result, 'content') and isinstance(result.content, list):
                             contentParts = []
@@ -457,8 +583,20 @@ async def process_chat(message: str, role: str, tools: bool, websocket: Optional
                         else:
                             toolResult = str(result.content)
                         
-                        if websocket and not auto_approve:
-                            await websocket.send_json({
+                        if getattr(result, "isError", False):
+                            # The tool ran but reported a failure, which is an error as far as the user is concerned
+                            metrics.toolErrors.inc(server=serverName, tool=toolName)
+                            if websocket and not auto_approve:
+                                hub.send(websocket, {
+                                    "type": "tool_error",
+                                    "tool_name": fullToolName,
+                                    "tool_call_id": toolCall.id,
+                                    "error": toolResult
+                                })
+                            else:
+                                print(f"❌ Tool returned an error: {toolResult}")
+                        elif websocket and not auto_approve:
+                            hub.send(websocket, {
                                 "type": "tool_success",
                                 "tool_name": fullToolName,
                                 "tool_call_id": toolCall.id
@@ -466,9 +604,10 @@ async def process_chat(message: str, role: str, tools: bool, websocket: Optional
                         else:
                             print(f"✅ Tool executed successfully")
                     else:
+                        metrics.toolErrors.inc(server=serverName or "", tool=toolName)
                         toolResult = json.dumps({"error": f"Server '{serverName}' not found"})
                         if websocket and not auto_approve:
-                            await websocket.send_json({
+                            hub.send(websocket, {
                                 "type": "tool_error",
                                 "tool_name": fullToolName,
                                 "tool_call_id": toolCall.id,
@@ -478,9 +617,10 @@ async def process_chat(message: str, role: str, tools: bool, websocket: Optional
                             print(f"❌ Server not found: {serverName}")
                 
                 except Exception as e:
+                    metrics.toolErrors.inc(server=serverName or "", tool=toolName)
                     toolResult = json.dumps({"error": str(e)})
                     if websocket and not auto_approve:
-                        await websocket.send_json({
+                        hub.send(websocket, {
                             "type": "tool_error",
                             "tool_name": fullToolName,
                             "tool_call_id": toolCall.id,
@@ -496,20 +636,22 @@ async def process_chat(message: str, role: str, tools: bool, websocket: Optional
                     toolResult = json.dumps({"error": "Tool call denied by user"})
                 
                 if websocket and not auto_approve:
-                    await websocket.send_json({
+                    hub.send(websocket, {
                         "type": "tool_denied",
                         "tool_name": fullToolName,
                         "tool_call_id": toolCall.id,
                         "reason": reason
                     })
             
-            # Add tool result to messages
+            # Add tool result to messages, keeping any overflow server side
             messages.append({
                 "role": "tool",
                 "tool_call_id": toolCall.id,
-                "content": toolResult
+                "content": toolResults.cap(toolResult)
             })
     
+    metrics.maxIterationExhausted.inc()
+    metrics.turnIterations.observe(iteration)
     return "Maximum iterations reached. Please try again"
 
 
@@ -1,18 +1,23 @@
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
-from openai import OpenAI
+from fastapi.responses import FileResponse, PlainTextResponse
+from openai import AsyncOpenAI
 import json
 import asyncio
 from typing import Optional, Dict
 from chatMessage import ChatMessage
-from watchfiles import awatch
 import os
-import glob
 import tools
 from dotenv import load_dotenv
-from tts import TTS
+from tts import TTS, MIME_TYPES, PCM_SAMPLE_RATE
+from toolResults import ToolResultStore, fetchMoreTool, FETCH_MORE_TOOL_NAME
+import metrics
+from promptIngest import PromptConsumer
+from promptRoutes import promptRouter
+from broadcastHub import BroadcastHub
+from pregen import Pregenerator, TurnTracker
+from audioSessions import AudioSessions
 load_dotenv()
 app = FastAPI()
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -27,98 +32,122 @@ app.add_middleware(
 )
 
 # Initialize OpenAI client and database
-ttsClient = OpenAI(
+ttsClient = AsyncOpenAI(
     api_key="none",base_url="http://localhost:7778/v1"
 )
 ttsGen = TTS(ttsClient) 
-client = OpenAI(api_key="none", base_url="http://localhost:5001/v1")
+audio_sessions = AudioSessions(ttsGen.cache)
+# Async, so a turn (or a background pre-generation) never blocks the event loop while the model runs
+client = AsyncOpenAI(api_key="none", base_url="http://localhost:5001/v1")
 db = ChatMessage("chatMemory.db")
+toolResults = ToolResultStore()
+hub = BroadcastHub()
+chat_turns = TurnTracker()
+# Speak scheduled replies too, synthesized ahead of time along with the text when the prompt is announced
+SCHEDULED_AUDIO = os.getenv("SCHEDULED_AUDIO", "0") == "1"
+pregenerator = Pregenerator(lambda prompt: pregenerate_scheduled_reply(prompt), chat_turns, db.latestId)
+prompt_consumer = PromptConsumer(
+    lambda prompt: handle_scheduled_prompt(prompt), lambda prompt, prepared: deliver_scheduled_reply(prompt, prepared), pregenerator)
+app.include_router(promptRouter(prompt_consumer))
 
 background_tasks = set()
-active_websockets: set = set()
 pending_approvals: Dict[int, Dict[str, asyncio.Queue]] = {}
 
 
-async def watch_for_scheduled_prompts():
-    """Watch for pending_prompt.json creation and trigger chatbot"""
-    print("👀 Watching for scheduled prompts...")
-    try:
-        async for changes in awatch(".", debounce=200):
-            for _, path in changes:
-                if os.path.basename(path) == "pending_prompt.json":
-                    try:
-                        await asyncio.sleep(0.05)
-                        with open(path, "r") as f:
-                            data = json.load(f)
-                            prompts_queue = data.get("prompts", [])
-                            system_prompt = prompts_queue[0]["developerPrompt"] if prompts_queue else None
-                        
-                        if system_prompt is None:
-                            continue
-
-                        print(f"\n🕐 System Trigger: {system_prompt}")
-                        
-                        # Clear the file
-                        with open(path, "w") as f:
-                            prompts_queue = prompts_queue[1:]
-                            json.dump({"prompts": prompts_queue}, f)
-                       
-                        # Handle the scheduled prompt
-                        await handle_scheduled_prompt(system_prompt)
-                        
-                    except Exception as e:
-                        print(f"⚠️ Error handling scheduled prompt: {e}")
-    except Exception as e:
-        print(f"❌ Error in scheduled prompt watcher: {e}")
-
-
 async def handle_scheduled_prompt(prompt: str):
     """Process a scheduled prompt and broadcast to all connected clients"""
     if not prompt:
         return
     
     # Process without tools for developer prompts
-    response = await process_chat(
-        message=prompt,
-        role="developer",
-        use_tools=False,
-        websocket=None,
-        connection_id=None,
-        auto_approve=True
-    )
+    with chat_turns.track():
+        response = await process_chat(
+            message=prompt,
+            role="developer",
+            use_tools=False,
+            websocket=None,
+            connection_id=None,
+            auto_approve=True
+        )
     
     # Broadcast to all connected clients
     await broadcast_scheduled_message(prompt, response)
     
     print(f"\nAssistant: {response}\n")
+    if SCHEDULED_AUDIO and response:
+        broadcast_scheduled_audio(await synthesize_reply(response))
     return response
 
 
+async def pregenerate_scheduled_reply(prompt: str):
+    """Reply, and its audio, for an announced prompt, kept out of the history until it is delivered"""
+    reply = await process_chat(
+        message=prompt,
+        role="developer",
+        use_tools=False,
+        websocket=None,
+        connection_id=None,
+        auto_approve=True,
+        save_reply=False
+    )
+    audio = await synthesize_reply(reply) if SCHEDULED_AUDIO and reply else []
+    return {"reply": reply, "audio": audio}
+
+
+async def deliver_scheduled_reply(prompt: str, prepared: dict):
+    """Send a reply generated ahead of time, recording it in the history only now that it is due"""
+    db.saveMessage("assistant", prepared["reply"])
+    await broadcast_scheduled_message(prompt, prepared["reply"])
+    print(f"\nAssistant: {prepared['reply']}\n")
+    broadcast_scheduled_audio(prepared["audio"])
+
+
+async def synthesize_reply(text: str):
+    # Awaited on the event loop rather than in a worker thread, since the TTS and cache metrics are loop-only
+    chunks = ttsGen.chunk_text(text, 500)
+    return await ttsGen.synthesizeAll(chunks)
+
+
+def broadcast_scheduled_audio(audio: list):
+    websockets = hub.websockets()
+    if not audio or not websockets:
+        return
+    turn_id = audio_sessions.startTurn(id(ws) for ws in websockets)
+    for i, audio_data in enumerate(audio):
+        hub.broadcastBinary(audio_chunk_header(turn_id, i, len(audio)), audio_data)
+    hub.broadcast({"type": "audio_end", "turn_id": turn_id, "total_chunks": len(audio)})
+
+
 async def broadcast_scheduled_message(system_prompt: str, response: str):
     """Broadcast scheduled message to all connected WebSocket clients"""
-    message_data = {
+    # Serialized once and queued per client, so a slow client cannot hold up the rest
+    hub.broadcast({
         "type": "scheduled_message",
         "system_prompt": system_prompt,
         "response": response
+    })
+
+
+def audio_chunk_header(turn_id: str, chunk_index: int, total_chunks: Optional[int], frame_index: Optional[int] = None):
+    header = {
+        "type": "audio_chunk" if frame_index is None else "audio_frame",
+        "turn_id": turn_id,
+        "chunk_index": chunk_index,
+        "total_chunks": total_chunks,
+        "format": ttsGen.audioFormat,
+        "mime": MIME_TYPES.get(ttsGen.audioFormat, "audio/mpeg")
     }
-    
-    disconnected = set()
-    for ws in active_websockets:
-        try:
-            await ws.send_json(message_data)
-        except Exception as e:
-            print(f"Failed to send to client: {e}")
-            disconnected.add(ws)
-    
-    active_websockets.difference_update(disconnected)
+    if frame_index is not None:
+        header["frame_index"] = frame_index
+    if ttsGen.audioFormat == "pcm":
+        header["sample_rate"] = PCM_SAMPLE_RATE
+    return header
 
 
 @app.on_event("startup")
 async def startup_event():
     """Start watching for scheduled prompts"""
-    task = asyncio.create_task(watch_for_scheduled_prompts())
-    background_tasks.add(task)
-    task.add_done_callback(background_tasks.discard)
+    prompt_consumer.start(background_tasks)
     print("✅ Server started")
 
 
@@ -141,6 +170,12 @@ async def get_history():
     return {"messages": messages}
 
 
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus scrape endpoint"""
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
+
+
 @app.post("/api/clear-history")
 async def clear_history():
     db.clearHistory()
@@ -152,7 +187,7 @@ async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
     connection_id = id(websocket)
     pending_approvals[connection_id] = {}
-    active_websockets.add(websocket)
+    hub.register(websocket)
     
     # Queue for chat requests
     chat_queue = asyncio.Queue()
@@ -167,6 +202,10 @@ async def websocket_endpoint(websocket: WebSocket):
                 if message_type == "chat":
                     await chat_queue.put(data)
                     
+                elif message_type == "audio_ack":
+                    # The client finished (or gave up on) playing this turn's audio
+                    audio_sessions.release(data.get("turn_id"), connection_id)
+
                 elif message_type == "tool_approval":
                     # Handle tool approval response
                     tool_call_id = data.get("tool_call_id")
@@ -195,14 +234,15 @@ async def websocket_endpoint(websocket: WebSocket):
                     continue
                 
                 # Process chat with tools and approval
-                await process_chat(
-                    message=user_message,
-                    role="user",
-                    use_tools=True,
-                    websocket=websocket,
-                    connection_id=connection_id,
-                    auto_approve=False
-                )
+                with chat_turns.track():
+                    await process_chat(
+                        message=user_message,
+                        role="user",
+                        use_tools=True,
+                        websocket=websocket,
+                        connection_id=connection_id,
+                        auto_approve=False
+                    )
                 
                 # # Send final response
                 # await websocket.send_json({
@@ -232,7 +272,8 @@ async def websocket_endpoint(websocket: WebSocket):
         processor_task.cancel()
         
         # Cleanup
-        active_websockets.discard(websocket)
+        await hub.unregister(websocket)
+        audio_sessions.disconnect(connection_id)
         if connection_id in pending_approvals:
             del pending_approvals[connection_id]
         try:
@@ -246,7 +287,8 @@ async def process_chat(
     use_tools: bool,
     websocket: Optional[WebSocket],
     connection_id: Optional[int],
-    auto_approve: bool = False
+    auto_approve: bool = False,
+    save_reply: bool = True
 ):
     """Process chat with optional tool calling and approval
     
@@ -257,6 +299,7 @@ async def process_chat(
         websocket: WebSocket for sending approval requests (None = auto-approve)
         connection_id: Connection ID for tracking approvals (None = auto-approve)
         auto_approve: If True, skip approval requests and execute immediately
+        save_reply: If False, the reply is returned without being saved to the history
     """
     
     system_prompt = (
@@ -274,13 +317,6 @@ async def process_chat(
         "- Examples of when TO use tools: 'add this anime', 'search for anime', 'update my progress'"
     )
     
-    tempAudioFiles = glob.glob("static/tts/temp_audio*.mp3")
-    print(f"Temp audio files found: {tempAudioFiles}")
-        #delete temp files if previous temp files exists
-
-    for temp_file in tempAudioFiles:
-        if os.path.exists(temp_file):
-            os.remove(temp_file)
     messages = [{"role": "system", "content": system_prompt}]
     
     # Add chat history
@@ -309,34 +345,41 @@ async def process_chat(
         
         # Only add tools if enabled
         if use_tools:
-            api_params["tools"] = tools.toolset
+            api_params["tools"] = tools.toolset + [fetchMoreTool]
             api_params["tool_choice"] = "auto"
         
-        response = client.chat.completions.create(**api_params)
+        metrics.iterationsTotal.inc()
+        with metrics.llmLatency.time(iteration=iteration):
+            response = await client.chat.completions.create(**api_params)
         response_message = response.choices[0].message
         
         # No tool calls - return response
         if not response_message.tool_calls:
             reply = response_message.content
-            db.saveMessage("assistant", reply)
+            if save_reply:
+                db.saveMessage("assistant", reply)
 
             if websocket:
-                await websocket.send_json({
+                hub.send(websocket, {
                     "type": "message",
                     "role": "assistant",
                     "content": reply
                 })
 
             if websocket:
-                asyncio.create_task(generateAndStream(reply, websocket, ttsGen))
+                turn_id = audio_sessions.startTurn([connection_id])
+                audio_sessions.attach(turn_id, asyncio.create_task(generateAndStream(reply, websocket, ttsGen, turn_id)))
             
+            metrics.turnIterations.observe(iteration)
             return reply
         
         # If tools disabled but got tool calls anyway (shouldn't happen)
         if not use_tools:
             reply = response_message.content or "I cannot use tools right now."
-            db.saveMessage("assistant", reply)
+            if save_reply:
+                db.saveMessage("assistant", reply)
             
+            metrics.turnIterations.observe(iteration)
             return reply
         
         # Add assistant message with tool calls
@@ -362,6 +405,15 @@ async def process_chat(
             
             print(f"🔧 Model wants to call: {function_name}")
             print(f"📝 Arguments: {function_args}")
+
+            # Paging through an earlier oversized result never needs approval
+            if function_name == FETCH_MORE_TOOL_NAME:
+                messages.append({
+                    "role": "tool",
+                    "tool_call_id": tool_call.id,
+                    "content": toolResults.fetchMore(function_args.get("handle", ""))
+                })
+                continue
             
             # Handle approval
             approved = False
@@ -382,7 +434,7 @@ async def process_chat(
                     pending_approvals[connection_id][tool_call.id] = asyncio.Queue()
                     
                     # Request approval from user
-                    await websocket.send_json({
+                    hub.send(websocket, {
                         "type": "tool_call_request",
                         "tool_name": function_name,
                         "arguments": function_args,
@@ -392,7 +444,8 @@ async def process_chat(
                     print(f"⏳ Waiting for user approval...")
                     
                     # Wait for approval response
-                    approval_response = await pending_approvals[connection_id][tool_call.id].get()
+                    with metrics.approvalWait.time():
+                        approval_response = await pending_approvals[connection_id][tool_call.id].get()
                     approved = approval_response.get("approved", False)
                     denial_reason = approval_response.get("reason", "")
                     
@@ -408,29 +461,31 @@ async def process_chat(
             if approved:
                 # Notify execution started
                 if websocket and not auto_approve:
-                    await websocket.send_json({
+                    hub.send(websocket, {
                         "type": "tool_executing",
                         "tool_name": function_name,
                         "tool_call_id": tool_call.id
                     })
               
                 try:    
-                    function_response=tools.executeTools(function_name, function_args)
+                    with metrics.toolLatency.time(server="local", tool=function_name):
+                        function_response=await tools.executeTools(function_name, function_args)
                     print(f"✅ Function executed: {function_response}\n")
                     
                     if websocket and not auto_approve:
-                        await websocket.send_json({
+                        hub.send(websocket, {
                             "type": "tool_success",
                             "tool_name": function_name,
                             "tool_call_id": tool_call.id
                         })
                         
                 except Exception as e:
+                    metrics.toolErrors.inc(server="local", tool=function_name)
                     function_response = json.dumps({"error": str(e)})
                     print(f"❌ Function error: {e}\n")
                     
                     if websocket and not auto_approve:
-                        await websocket.send_json({
+                        hub.send(websocket, {
                             "type": "tool_error",
                             "tool_name": function_name,
                             "tool_call_id": tool_call.id,
@@ -448,7 +503,7 @@ async def process_chat(
                     })
                 
                 if websocket and not auto_approve:
-                    await websocket.send_json({
+                    hub.send(websocket, {
                         "type": "tool_denied",
                         "tool_name": function_name,
                         "tool_call_id": tool_call.id,
@@ -460,33 +515,40 @@ async def process_chat(
             messages.append({
                 "role": "tool",
                 "tool_call_id": tool_call.id,
-                "content": function_response
+                "content": toolResults.cap(function_response)
             })
     
+    metrics.maxIterationExhausted.inc()
+    metrics.turnIterations.observe(iteration)
     return "Maximum iterations reached. Please try again"
 
 
-async def generateAndStream(text: str, websocket: WebSocket, ttsGenerator: TTS):
+async def generateAndStream(text: str, websocket: WebSocket, ttsGenerator: TTS, turn_id: str):
+    sent = 0
     try:
         chunks = ttsGenerator.chunk_text(text, 500)
 
-        async for audio_chunk_info in ttsGenerator.generateStreaming(chunks, "./static/tts"):
-           await asyncio.sleep(0.01)
-           
-           await websocket.send_json({
-                "type": "audio_chunk",
-                "chunk_index": audio_chunk_info["chunk_index"],
-                "total_chunks": audio_chunk_info["total_chunks"],
-                "audio_file": audio_chunk_info["audio_file"]
-            })
-            # 
-
-        # await websocket.send_json({
-        #     "type": "audio_complete",
-        #     "audio_file": "audio.mp3"
-        # })
+        # Audio goes out as binary frames, never touching the disk, tagged with this turn's id
+        if ttsGenerator.audioFormat == "pcm":
+            # Forward each frame as the TTS backend streams it, the client plays them back to back
+            async for frame_info in ttsGenerator.generateFrames(chunks, audio_sessions.pinner(turn_id)):
+                if not hub.sendBinary(websocket, audio_chunk_header(
+                        turn_id, frame_info["chunk_index"], frame_info["total_chunks"], frame_info["frame_index"]), frame_info["audio"]):
+                    break  # The client fell behind and the rest of this turn is being skipped
+                sent = frame_info["chunk_index"] + 1
+        else:
+            async for audio_chunk_info in ttsGenerator.generateStreaming(chunks, audio_sessions.pinner(turn_id)):
+                if not hub.sendBinary(websocket, audio_chunk_header(
+                        turn_id, audio_chunk_info["chunk_index"], audio_chunk_info["total_chunks"]), audio_chunk_info["audio"]):
+                    break
+                sent += 1
+        hub.send(websocket, {"type": "audio_end", "turn_id": turn_id, "total_chunks": sent})
+    except asyncio.CancelledError:
+        raise
     except Exception as e:
         print(f"Error generating audio: {e}")
+        # Nothing more is coming, so let the client release the turn
+        hub.send(websocket, {"type": "audio_end", "turn_id": turn_id, "total_chunks": sent})
 
 
 if __name__ == "__main__":
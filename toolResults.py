@@ -0,0 +1,73 @@
+import json
+import os
+import uuid
+from collections import OrderedDict
+
+FETCH_MORE_TOOL_NAME = "fetchMoreToolResult"
+
+fetchMoreTool = {
+    "type": "function",
+    "function": {
+        "name": FETCH_MORE_TOOL_NAME,
+        "description": "Fetch the next page of a tool result that was cut off. Only use this when a previous tool result ended with a continuation handle and you need the rest of it. Args: handle: the continuation handle from the truncated tool result",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "handle": {"type": "string", "description": "the continuation handle from the truncated tool result"}
+            },
+            "required": ["handle"]
+        }
+    }
+}
+
+
+class ToolResultStore:
+    """Caps the size of tool results and keeps the overflow server side so the model can page through it"""
+
+    def __init__(self, maxChars=None, maxEntries=64):
+        # Roughly 4 characters per token, so the default keeps each result near 1000 tokens
+        self.maxChars = maxChars or int(os.getenv("TOOL_RESULT_MAX_CHARS", "4000"))
+        self.maxEntries = maxEntries
+        self.pending = OrderedDict()
+
+    def cap(self, text):
+        """Return the first page of text, storing the rest behind a continuation handle"""
+        if text is None or len(text) <= self.maxChars:
+            return text
+
+        page, rest = self.splitPage(text)
+        handle = uuid.uuid4().hex[:12]
+        self.pending[handle] = rest
+
+        # Forget the oldest overflow once we hold too many
+        while len(self.pending) > self.maxEntries:
+            self.pending.popitem(last=False)
+
+        return self.formatPage(page, handle, len(rest))
+
+    def fetchMore(self, handle):
+        """Return the next page for a continuation handle"""
+        rest = self.pending.pop(handle, None)
+        if rest is None:
+            return json.dumps({"error": f"No more results for handle '{handle}'"})
+
+        if len(rest) <= self.maxChars:
+            return rest
+
+        page, rest = self.splitPage(rest)
+        self.pending[handle] = rest
+        return self.formatPage(page, handle, len(rest))
+
+    def splitPage(self, text):
+        # Prefer cutting on a line break so rows and sentences stay whole
+        cut = text.rfind("\n", 0, self.maxChars)
+        if cut <= self.maxChars // 2:
+            cut = self.maxChars
+        return text[:cut], text[cut:].lstrip("\n")
+
+    def formatPage(self, page, handle, remaining):
+        return (
+            f"{page}\n"
+            f"[Result truncated, {remaining} characters remaining. "
+            f"Call {FETCH_MORE_TOOL_NAME} with handle '{handle}' only if you need the rest.]"
+        )
@@ -0,0 +1,113 @@
+import math
+import os
+import re
+from collections import Counter
+
+STOPWORDS = {
+    "a", "an", "the", "and", "or", "of", "to", "in", "on", "for", "with", "is", "it", "this", "that",
+    "be", "use", "used", "tool", "tools", "args", "you", "your", "i", "me", "my", "can", "should",
+    "will", "what", "when", "how", "if", "do", "are", "as", "by", "from", "its", "it's", "not", "like",
+}
+
+
+def tokenize(text):
+    """Split text into lowercase search terms, breaking camelCase and snake_case names apart"""
+    if not text:
+        return []
+    text = re.sub(r"([a-z0-9])([A-Z])", r"\1 \2", text)
+    terms = []
+    for word in re.findall(r"[a-zA-Z0-9]+", text.lower()):
+        if word in STOPWORDS or len(word) < 2:
+            continue
+        # Cheap plural folding so "episodes" matches "episode"
+        if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+            word = word[:-1]
+        terms.append(word)
+    return terms
+
+
+class ToolSelector:
+    """BM25 index over tool names and descriptions used to send only the relevant tools each turn"""
+
+    def __init__(self, topK=None, minScore=None, minShare=0.6, k1=1.2, b=0.75):
+        self.topK = topK or int(os.getenv("TOOL_SELECTOR_TOP_K", "3"))
+        self.minScore = minScore if minScore is not None else float(os.getenv("TOOL_SELECTOR_MIN_SCORE", "1.5"))
+        self.minShare = minShare
+        self.k1 = k1
+        self.b = b
+        self.serverTools = {}
+        self.entries = []
+        self.idf = {}
+        self.avgLength = 0
+
+    def addServer(self, serverName, openAITools):
+        """Index the OpenAI formatted tools of one server, replacing any previous ones"""
+        self.serverTools[serverName] = openAITools
+        self.rebuild()
+
+    def removeServer(self, serverName):
+        if self.serverTools.pop(serverName, None) is not None:
+            self.rebuild()
+
+    def allTools(self):
+        return [entry["tool"] for entry in self.entries]
+
+    def rebuild(self):
+        self.entries = []
+        for openAITools in self.serverTools.values():
+            for tool in openAITools:
+                function = tool["function"]
+                # Count the name twice so a hit on it outweighs a passing mention in a docstring
+                terms = tokenize(function["name"]) * 2 + tokenize(function.get("description", ""))
+                self.entries.append({"tool": tool, "terms": Counter(terms), "length": len(terms)})
+
+        documentCount = len(self.entries)
+        documentFrequency = Counter()
+        for entry in self.entries:
+            documentFrequency.update(entry["terms"].keys())
+
+        self.idf = {
+            term: math.log(1 + (documentCount - freq + 0.5) / (freq + 0.5))
+            for term, freq in documentFrequency.items()
+        }
+        self.avgLength = sum(entry["length"] for entry in self.entries) / documentCount if documentCount else 0
+
+    def score(self, queryTerms):
+        scores = []
+        for entry in self.entries:
+            score = 0.0
+            norm = self.k1 * (1 - self.b + self.b * entry["length"] / self.avgLength) if self.avgLength else self.k1
+            for term, weight in queryTerms.items():
+                tf = entry["terms"].get(term)
+                if tf:
+                    score += weight * self.idf[term] * tf * (self.k1 + 1) / (tf + norm)
+            scores.append(score)
+        return scores
+
+    def select(self, message, context=()):
+        """Return the top scoring tools for the message, or every tool when the match is not convincing
+
+        Args:
+            message: the current user message
+            context: recent earlier messages, weighted at half the current message
+        """
+        if len(self.entries) <= self.topK:
+            return self.allTools()
+
+        queryTerms = Counter()
+        for term in tokenize(message):
+            queryTerms[term] += 1.0
+        for text in context:
+            for term in tokenize(text):
+                queryTerms[term] += 0.5
+
+        scores = self.score(queryTerms)
+        ranked = sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)
+        top = ranked[:self.topK]
+        total = sum(scores)
+
+        # Low confidence: nothing matches well, or the match is spread over many tools
+        if scores[top[0]] < self.minScore or sum(scores[i] for i in top) < self.minShare * total:
+            return self.allTools()
+
+        return [self.entries[i]["tool"] for i in top if scores[i] > 0]
@@ -1,5 +1,10 @@
+import asyncio
+import inspect
 import json
+import os
 from mcpServers.mcpServer import searchAnime, getAnimeInfo
+
+TOOL_TIMEOUT = float(os.getenv("TOOL_TIMEOUT", "30"))
 toolset = [
     {
         "type": "function",
@@ -31,13 +36,30 @@ toolset = [
     }
 ]
 
-def executeTools(name, args):
+registry = {}
+
+
+def registerTool(name, function):
+    """Make an async function callable by name through executeTools
+
+    Tools run on the event loop, so any blocking work inside them has to be
+    moved off it by the tool itself, as the Jikan client does.
+    """
+    if not inspect.iscoroutinefunction(function):
+        raise TypeError(f"Tool {name} must be an async function")
+    registry[name] = function
+
+
+registerTool("searchAnime", searchAnime)
+registerTool("getAnimeInfo", getAnimeInfo)
+
+
+async def executeTools(name, args, timeout=TOOL_TIMEOUT):
+    function = registry.get(name)
+    if function is None:
+        return(json.dumps({"error": "Unknown function"}))
 
-    match name:
-        case "searchAnime":
-            return(searchAnime(**args))
-        case "getAnimeInfo":
-            return(getAnimeInfo(**args))
-        case _:
-            return(json.dumps({"error": "Unknown function"}))
-    
\ No newline at end of file
+    try:
+        return(await asyncio.wait_for(function(**args), timeout))
+    except asyncio.TimeoutError:
+        raise TimeoutError(f"{name} timed out after {timeout:g} seconds")
@@ -1,136 +1,515 @@
+import asyncio
+import hashlib
 import os
-import ffmpeg
+from collections import OrderedDict
+from openai import AsyncOpenAI
+import metrics
+from mp3Concat import concatMp3, Mp3FormatError
+
+# Requests in flight against the TTS backend, shared by every reply being spoken
+TTS_CONCURRENCY = int(os.getenv("TTS_CONCURRENCY", "3"))
+TTS_MODEL = "global_preset"
+# mp3 and opus are sent a whole chunk at a time; pcm (16-bit mono) is forwarded frame by frame as it is synthesized
+TTS_AUDIO_FORMAT = os.getenv("TTS_AUDIO_FORMAT", "mp3")
+PCM_SAMPLE_RATE = 24000
+PCM_FRAME_BYTES = int(os.getenv("TTS_PCM_FRAME_BYTES", "4800"))  # 100 ms, must stay even
+MIME_TYPES = {"mp3": "audio/mpeg", "opus": "audio/ogg", "pcm": "audio/pcm"}
+
+defaultCacheDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ttsCache")
+
+
+TTS_FIRST_CHUNK = int(os.getenv("TTS_FIRST_CHUNK", "80"))
+TTS_CHUNK_GROWTH = float(os.getenv("TTS_CHUNK_GROWTH", "2"))
+
+SENTENCE_END = ".!?\u2026"
+CLOSERS = "\"')]}\u201d\u2019\u00bb"
+CLAUSE_END = ",;:\u2014"
+ABBREVIATIONS = {"mr", "mrs", "ms", "dr", "prof", "sr", "jr", "st", "mt", "vs", "etc", "e.g", "i.e", "no", "approx", "ep", "vol"}
+
+
+class TextSegmenter:
+    """Single pass, incremental sentence chunker for TTS
+
+    Text can be fed all at once or token by token as it streams in; each feed
+    returns the chunks that became complete. Sentence ends skip abbreviations,
+    initials and mid-sentence ellipses. The first chunk targets firstChunk
+    characters so audio starts quickly, then the target grows by growth per
+    chunk up to maxChunk. Sentences longer than that are cut at a clause or,
+    failing that, a word boundary.
+    """
+
+    def __init__(self, firstChunk=TTS_FIRST_CHUNK, maxChunk=500, growth=TTS_CHUNK_GROWTH):
+        self.maxChunk = maxChunk
+        self.target = min(firstChunk, maxChunk)
+        self.growth = growth
+        self.buffer = ""  # Text of the sentence in progress
+        self.scan = 0  # Where in the buffer to resume looking for a sentence end
+        self.sentences = []  # Complete sentences waiting to fill the current chunk
+        self.length = 0
+
+    def feed(self, text):
+        self.buffer += text
+        chunks = []
+        for sentence in self.completeSentences():
+            chunks.extend(self.add(sentence))
+        chunks.extend(self.splitLongSentence())
+        # Only the text before scan surely belongs to the sentence in progress, so decide on that alone
+        if self.sentences and self.length + 1 + self.decidedLength() > self.target:
+            chunks.append(self.emit())
+        return chunks
+
+    def decidedLength(self):
+        return len(self.buffer[:self.scan].rstrip())
+
+    def flush(self):
+        """Chunks for whatever is left once the text has ended"""
+        chunks = []
+        rest = self.buffer.strip()
+        self.buffer, self.scan = "", 0
+        if rest:
+            chunks.extend(self.add(rest))
+        if self.sentences:
+            chunks.append(self.emit())
+        return chunks
+
+    def completeSentences(self):
+        text = self.buffer
+        n = len(text)
+        start = 0
+        i = self.scan
+        found = []
+        while i < n:
+            char = text[i]
+            if char == "\n":
+                if text[start:i].strip():
+                    found.append(text[start:i].strip())
+                start = i = i + 1
+                continue
+            if char not in SENTENCE_END:
+                i += 1
+                continue
+
+            end = i + 1
+            while end < n and text[end] in SENTENCE_END:
+                end += 1
+            while end < n and text[end] in CLOSERS:
+                end += 1
+            boundary = self.isBoundary(text, start, i, end)
+            if boundary is None:
+                break  # Depends on text that has not arrived yet
+            if boundary:
+                found.append(text[start:end].strip())
+                start = end
+            i = end
+
+        # The next sentence starts at its first word, as it does when the text arrives all at once
+        while start < i and text[start].isspace():
+            start += 1
+        self.buffer = text[start:]
+        self.scan = i - start
+        return [sentence for sentence in found if sentence]
+
+    def isBoundary(self, text, start, i, end):
+        """True, False, or None when the answer depends on text still to come"""
+        n = len(text)
+        if end == n:
+            return None
+        if not text[end].isspace():
+            return False  # 3.14, e.g.the, "Wait..." said
+
+        run = text[i:end].rstrip(CLOSERS)
+        if run.startswith("...") or run.startswith("\u2026"):
+            # An ellipsis only ends the sentence if the next word starts a new one
+            nextChar = end
+            while nextChar < n and text[nextChar].isspace():
+                nextChar += 1
+            if nextChar == n:
+                return None
+            return text[nextChar].isupper() or text[nextChar] in CLOSERS
+
+        if run == ".":
+            wordStart = i
+            while wordStart > start and not text[wordStart - 1].isspace():
+                wordStart -= 1
+            word = text[wordStart:i].lstrip("(\"'").lower()
+            if word in ABBREVIATIONS or (len(word) == 1 and word.isalpha()):
+                return False
+        return True
+
+    def add(self, sentence):
+        chunks = []
+        if not sentence:
+            return chunks
+        # Send what we have once the next sentence would not fit, rather than waiting to fill the chunk
+        if self.sentences and self.length + 1 + len(sentence) > self.target:
+            chunks.append(self.emit())
+        # Cut at the growing target, which never exceeds maxChunk, so this follows the same schedule as streaming
+        if len(sentence) > self.target:
+            cut = findCut(sentence, self.target // 2, self.target)
+            chunks.extend(self.add(sentence[:cut + 1].strip()))
+            chunks.extend(self.add(sentence[cut + 1:].strip()))
+            return chunks
+        self.sentences.append(sentence)
+        self.length += len(sentence) + (1 if len(self.sentences) > 1 else 0)
+        if self.length >= self.target:
+            chunks.append(self.emit())
+        return chunks
+
+    def emit(self):
+        chunk = " ".join(self.sentences)
+        self.sentences, self.length = [], 0
+        self.target = min(self.maxChunk, int(self.target * self.growth))
+        return chunk
+
+    def splitLongSentence(self):
+        """Cut the sentence still streaming in once it outgrows the chunk it is meant for"""
+        chunks = []
+        while self.decidedLength() > self.target:
+            if self.sentences:
+                chunks.append(self.emit())  # The sentence in progress can't join them, and the target grows
+                continue
+            # The cut only looks at text before the target, so it lands where add() would put it in the whole sentence
+            cut = findCut(self.buffer, self.target // 2, self.target)
+            piece = self.buffer[:cut + 1].strip()
+            rest = self.buffer[cut + 1:]
+            self.buffer = rest.lstrip()
+            self.scan -= cut + 1 + len(rest) - len(self.buffer)
+            chunks.extend(self.add(piece))
+        return chunks
+
+
+def findCut(text, low, high):
+    """Index to cut text after: the last clause break in [low, high), else the last space, else high - 1"""
+    cut = max(text.rfind(mark, low, high) for mark in CLAUSE_END)
+    if cut >= 0:
+        return cut
+    cut = text.rfind(" ", 0, high)
+    return cut if cut > 0 else high - 1
+
+
+async def segmentStream(tokens, firstChunk=TTS_FIRST_CHUNK, maxChunk=500, growth=TTS_CHUNK_GROWTH):
+    """Turn an async stream of text deltas into TTS chunks as soon as each one is complete"""
+    segmenter = TextSegmenter(firstChunk, maxChunk, growth)
+    async for token in tokens:
+        for chunk in segmenter.feed(token):
+            yield chunk
+    for chunk in segmenter.flush():
+        yield chunk
+
+
+class TTSCache:
+    """Content-addressed cache of synthesized audio on disk, evicted least recently used first
+
+    Entries are keyed by a hash of the model, voice and normalized text, so the
+    same phrase is only synthesized once. The in-memory index answers hit checks
+    without touching the disk and keeps the total size under maxBytes. A budget
+    of 0 disables the cache.
+    """
+
+    def __init__(self, path=None, maxBytes=None):
+        self.path = path or os.getenv("TTS_CACHE_DIR", defaultCacheDir)
+        self.maxBytes = maxBytes if maxBytes is not None else int(os.getenv("TTS_CACHE_BYTES", str(100 * 1024 * 1024)))
+        self.index = OrderedDict()  # key -> size in bytes, least recently used first
+        self.pinned = {}  # key -> number of turns using it
+        self.totalBytes = 0
+        if self.maxBytes > 0:
+            self.load()
+
+    def load(self):
+        os.makedirs(self.path, exist_ok=True)
+        entries = []
+        for name in os.listdir(self.path):
+            if os.path.splitext(name)[1][1:] in MIME_TYPES:
+                stat = os.stat(os.path.join(self.path, name))
+                entries.append((stat.st_mtime, name, stat.st_size))
+        # Access times are kept as mtimes, so the LRU order survives a restart
+        for _, key, size in sorted(entries):
+            self.index[key] = size
+            self.totalBytes += size
+        self.evict()
+
+    @staticmethod
+    def key(model, voice, text, audioFormat="mp3"):
+        normalized = " ".join(text.split())
+        # mp3 keys predate the format option, leave them as they were so existing entries still hit
+        variant = voice if audioFormat == "mp3" else f"{voice}\0{audioFormat}"
+        digest = hashlib.sha256(f"{model}\0{variant}\0{normalized}".encode("utf-8")).hexdigest()
+        # The key doubles as the file name, so each entry carries its own format's extension
+        return f"{digest}.{audioFormat}"
+
+    def filePath(self, key):
+        return os.path.join(self.path, key)
+
+    def get(self, key):
+        if key not in self.index:
+            metrics.ttsCacheLookups.inc(result="miss")
+            return None
+        try:
+            with open(self.filePath(key), "rb") as f:
+                audio = f.read()
+            os.utime(self.filePath(key))
+        except FileNotFoundError:
+            self.totalBytes -= self.index.pop(key)
+            metrics.ttsCacheLookups.inc(result="miss")
+            return None
+        self.index.move_to_end(key)
+        metrics.ttsCacheLookups.inc(result="hit")
+        return audio
+
+    def put(self, key, audio):
+        if self.maxBytes <= 0 or len(audio) > self.maxBytes:
+            return
+        tempPath = self.filePath(key) + ".tmp"
+        with open(tempPath, "wb") as f:
+            f.write(audio)
+        os.replace(tempPath, self.filePath(key))
+        self.totalBytes += len(audio) - self.index.pop(key, 0)
+        self.index[key] = len(audio)
+        self.evict()
+
+    def pin(self, key):
+        """Keep an entry from being evicted while a turn that uses it is still playing"""
+        self.pinned[key] = self.pinned.get(key, 0) + 1
+
+    def unpin(self, key):
+        if self.pinned.get(key, 0) <= 1:
+            self.pinned.pop(key, None)
+            self.evict()
+        else:
+            self.pinned[key] -= 1
+
+    def evict(self):
+        if self.totalBytes <= self.maxBytes:
+            return
+        for key in list(self.index):
+            if self.totalBytes <= self.maxBytes:
+                break
+            if key in self.pinned:
+                continue
+            self.totalBytes -= self.index.pop(key)
+            metrics.ttsCacheEvictions.inc()
+            try:
+                os.remove(self.filePath(key))
+            except FileNotFoundError:
+                pass
+
+
+def requestInOrder(chunks, request):
+    """Call request(chunk) for each chunk as soon as its text is known, queueing the results in order
+
+    The semaphore inside synthesis keeps the backend busy without flooding it.
+    Returns the queue, which ends with None, and the task feeding it.
+    """
+    requested = asyncio.Queue()
+
+    async def feed():
+        try:
+            if hasattr(chunks, "__aiter__"):
+                async for chunk in chunks:
+                    requested.put_nowait(request(chunk))
+            else:
+                for chunk in chunks:
+                    requested.put_nowait(request(chunk))
+        finally:
+            requested.put_nowait(None)
+
+    return requested, asyncio.create_task(feed())
+
+
 class TTS:
 
-    def __init__(self, client):
-        self.client = client
+    def __init__(self, client, concurrency=TTS_CONCURRENCY, cache=None, audioFormat=TTS_AUDIO_FORMAT):
+        self.client = client  # AsyncOpenAI
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.concurrency = concurrency
+        self.cache = cache if cache is not None else TTSCache()
+        self.audioFormat = audioFormat
 
     def chunk_text(self,text, max_chunk_size=500):
         """
         Split text into chunks at sentence boundaries without cutting words.
-        Falls back to word boundaries if sentences are too long.
+        Falls back to clause or word boundaries if sentences are too long.
+        The first chunk is kept small so audio can start sooner.
         """
-        # Split into sentences
-        sentences = []
-        for delimiter in ['. ', '! ', '? ', '.\n', '!\n', '?\n']:
-            text = text.replace(delimiter, delimiter + '<SPLIT>')
-        
-        raw_sentences = text.split('<SPLIT>')
-        sentences = [s.strip() for s in raw_sentences if s.strip()]
-        
-        chunks = []
-        current_chunk = ""
-        
-        for sentence in sentences:
-            # If a single sentence is longer than max_chunk_size, split it by words
-            if len(sentence) > max_chunk_size:
-                # First, save current chunk if it has content
-                if current_chunk:
-                    chunks.append(current_chunk.strip())
-                    current_chunk = ""
-                
-                # Split long sentence by words
-                words = sentence.split()
-                temp_chunk = ""
-                
-                for word in words:
-                    if len(temp_chunk) + len(word) + 1 <= max_chunk_size:
-                        temp_chunk += (" " + word if temp_chunk else word)
-                    else:
-                        if temp_chunk:
-                            chunks.append(temp_chunk.strip())
-                        temp_chunk = word
-                
-                # Set current_chunk to the last piece of the long sentence
-                if temp_chunk:
-                    current_chunk = temp_chunk
-            else:
-                # Try to add sentence to current chunk
-                test_chunk = current_chunk + (" " + sentence if current_chunk else sentence)
-                
-                if len(test_chunk) <= max_chunk_size:
-                    current_chunk = test_chunk
-                else:
-                    # Current chunk is full, save it and start new one
-                    if current_chunk:
-                        chunks.append(current_chunk.strip())
-                    current_chunk = sentence
-        
-        # Add the last chunk
-        if current_chunk:
-            chunks.append(current_chunk.strip())
-        
-        return chunks
+        segmenter = TextSegmenter(maxChunk=max_chunk_size)
+        return segmenter.feed(text) + segmenter.flush()
     
-    async def generateStreaming(self, chunks, outputPath):
-        os.makedirs(outputPath, exist_ok=True)
-        temp_files = []
+    async def synthesize(self, text, voice="chatterbox", semaphore=None, pin=None, audioFormat=None, client=None):
+        """Audio bytes for one chunk of text, from the cache when this phrase was spoken before
 
-        for i, chunk in enumerate(chunks):
-            temp_file = outputPath +f"/temp_audio_{i}.mp3"
-            
-            with self.client.audio.speech.with_streaming_response.create(
-                model="global_preset",
-                voice="chatterbox",
-                input=chunk,
-            ) as response:
-                audio_data = response.read()
-                with open(temp_file, "wb") as f:
-                    f.write(audio_data)
-            
-            temp_files.append(temp_file)
+        pin, if given, is called with the cache key so the caller can keep the entry resident.
+        client replaces self.client for callers running on an event loop of their own.
+        """
+        audioFormat = audioFormat or self.audioFormat
+        key = self.cacheKey(text, voice, pin, audioFormat)
+        audio = self.cache.get(key)
+        if audio is not None:
+            return audio
+
+        async with semaphore or self.semaphore:
+            with metrics.ttsChunkLatency.time():
+                async with (client or self.client).audio.speech.with_streaming_response.create(
+                    model=TTS_MODEL,
+                    voice=voice,
+                    input=text,
+                    response_format=audioFormat,
+                ) as response:
+                    audio = await response.read()
+        self.cache.put(key, audio)
+        return audio
+
+    async def streamChunk(self, text, voice="chatterbox", pin=None):
+        """Yield one chunk's audio frame by frame as the backend produces it, rather than after it is complete"""
+        key = self.cacheKey(text, voice, pin, self.audioFormat)
+        audio = self.cache.get(key)
+        if audio is not None:
+            for start in range(0, len(audio), PCM_FRAME_BYTES):
+                yield audio[start:start + PCM_FRAME_BYTES]
+            return
+
+        frames = []
+        async with self.semaphore:
+            with metrics.ttsChunkLatency.time():
+                async with self.client.audio.speech.with_streaming_response.create(
+                    model=TTS_MODEL,
+                    voice=voice,
+                    input=text,
+                    response_format=self.audioFormat,
+                ) as response:
+                    async for frame in response.iter_bytes(PCM_FRAME_BYTES):
+                        frames.append(frame)
+                        yield frame
+        self.cache.put(key, b"".join(frames))
 
-            yield {
-                "chunk_index": i,
-                "total_chunks": len(chunks),
-                "audio_file": f"temp_audio_{i}.mp3"
-            }
+    def cacheKey(self, text, voice, pin, audioFormat):
+        key = TTSCache.key(TTS_MODEL, voice, text, audioFormat)
+        if pin is not None:
+            pin(key)
+        return key
 
-        # await self.concatAudio(temp_files, f"{outputPath}/audio.mp3")
-        
-    async def concatAudio(self, temp_files, outputPath):
+    async def synthesizeAll(self, chunks, voice="chatterbox", semaphore=None, audioFormat=None, client=None):
+        return await asyncio.gather(*(self.synthesize(chunk, voice, semaphore, audioFormat=audioFormat, client=client) for chunk in chunks))
+
+    async def generateStreaming(self, chunks, pin=None):
+        """Yield each chunk's audio bytes in order, straight from memory
+
+        chunks is a list, or an async iterator such as segmentStream over text that
+        is still being generated, in which case total_chunks is None. pin is passed
+        on to synthesize.
+        """
+        total = None if hasattr(chunks, "__aiter__") else len(chunks)
+        tasks = []
+
+        def request(chunk):
+            task = asyncio.create_task(self.synthesize(chunk, pin=pin))
+            tasks.append(task)
+            return task
+
+        requested, feeder = requestInOrder(chunks, request)
         try:
-            inputs = [ffmpeg.input(f) for f in temp_files]
-            join = ffmpeg.concat(*inputs, v=0, a=1)
-            output = ffmpeg.output(join, outputPath)
-            ffmpeg.run(output, overwrite_output=True, quiet=True)
-            print("Audio concat success")
-        except ffmpeg.Error as e:
-            print(f"FFMPEG error: {e.stderr.decode()}")
-            raise
+            index = 0
+            while (task := await requested.get()) is not None:
+                yield {
+                    "chunk_index": index,
+                    "total_chunks": total,
+                    "audio": await task
+                }
+                index += 1
+            await feeder  # Surface an error from the text stream
+        finally:
+            # The listener went away or a chunk failed, stop paying for the rest
+            feeder.cancel()
+            for task in tasks:
+                task.cancel()
 
+    async def generateFrames(self, chunks, pin=None):
+        """Like generateStreaming, but yields each chunk's audio frames as soon as the backend sends them
+
+        Later chunks are still synthesized in parallel and buffered until every
+        chunk before them has been forwarded. Meant for the pcm format.
+        """
+        total = None if hasattr(chunks, "__aiter__") else len(chunks)
+        tasks = []
+
+        def request(chunk):
+            frames = asyncio.Queue()
+
+            async def pump():
+                try:
+                    async for frame in self.streamChunk(chunk, pin=pin):
+                        frames.put_nowait(frame)
+                finally:
+                    frames.put_nowait(None)
+
+            task = asyncio.create_task(pump())
+            tasks.append(task)
+            return task, frames
+
+        requested, feeder = requestInOrder(chunks, request)
+        try:
+            index = 0
+            while (item := await requested.get()) is not None:
+                task, frames = item
+                frameIndex = 0
+                while (frame := await frames.get()) is not None:
+                    yield {
+                        "chunk_index": index,
+                        "total_chunks": total,
+                        "frame_index": frameIndex,
+                        "audio": frame
+                    }
+                    frameIndex += 1
+                await task  # Surface a chunk that failed part way
+                index += 1
+            await feeder
+        finally:
+            feeder.cancel()
+            for task in tasks:
+                task.cancel()
 
     def generate(self, text_chunks, outputPath):
         os.makedirs("./static/tts", exist_ok=True)
-        temp_files = []
 
-        for i, chunk in enumerate(text_chunks):
+        async def synthesizeChunks():
+            # asyncio.run gives this its own event loop, and the shared client's connections belong to the
+            # first loop that used it, so take a fresh client and semaphore and close the client before returning
+            async with AsyncOpenAI(api_key=self.client.api_key, base_url=self.client.base_url) as client:
+                return await self.synthesizeAll(text_chunks, "chatterbox-jeanette", asyncio.Semaphore(self.concurrency), "mp3", client)
+
+        audio = asyncio.run(synthesizeChunks())
+        try:
+            # Same voice and codec, so the frames can be joined as they are
+            concatMp3(audio, outputPath+"/audio.mp3")
+            print("Audio concatenated successfully!")
+            return
+        except Mp3FormatError as e:
+            print(f"Falling back to ffmpeg: {e}")
+
+        temp_files = []
+        for i, audio_data in enumerate(audio):
             temp_file = outputPath +f"/temp_audio_{i}.mp3"
-            
-            with self.client.audio.speech.with_streaming_response.create(
-                model="global_preset",
-                voice="chatterbox-jeanette",
-                input=chunk,
-            ) as response:
-                audio_data = response.read()
-                with open(temp_file, "wb") as f:
-                    f.write(audio_data)
-            
+            with open(temp_file, "wb") as f:
+                f.write(audio_data)
             temp_files.append(temp_file)
 
         try:
+            ffmpegConcat(temp_files, outputPath+"/audio.mp3")
+            print("Audio concatenated with the ffmpeg fallback")
+        finally:
+            for temp_file in temp_files:
+                if os.path.exists(temp_file):
+                    os.remove(temp_file)
 
-            inputs = [ffmpeg.input(f) for f in temp_files]
-            joined = ffmpeg.concat(*inputs, v=0, a=1)
-            output = ffmpeg.output(joined, outputPath+"/audio.mp3")
-            ffmpeg.run(output, overwrite_output=True, quiet=True)
-            
-            print("Audio concatenated successfully!")
-            
-        except ffmpeg.Error as e:
-            print(f"FFmpeg error: {e.stderr.decode()}")
-            raise
-
-        for temp_file in temp_files:
-            if os.path.exists(temp_file):
-                os.remove(temp_file)
\ No newline at end of file
+
+def ffmpegConcat(files, outputPath):
+    """Decode and re-encode, for chunks whose formats differ"""
+    import ffmpeg
+
+    try:
+        inputs = [ffmpeg.input(f) for f in files]
+        joined = ffmpeg.concat(*inputs, v=0, a=1)
+        output = ffmpeg.output(joined, outputPath)
+        ffmpeg.run(output, overwrite_output=True, quiet=True)
+    except ffmpeg.Error as e:
+        print(f"FFmpeg error: {e.stderr.decode()}")
+        raise
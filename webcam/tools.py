@@ -1,5 +1,9 @@
 import os
-import json
+import sys
+
+# promptIngest lives in the project root, one level above this script
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from promptIngest import submitPrompt, PRIORITY_OBSERVATION
 toolset = [
     {
   "name": "writeDeveloperPrompt",
@@ -23,27 +27,10 @@ def writeDeveloperPrompt(developerPrompt: str):
     Arguments
       developerPrompt: the developer prompt that will logged. It should be formatted like you see (observation from image here) respond to the user about the observation as a natural companion speech"
     """
-    filename= "pending_prompt.json"
     try:
-        if os.path.exists(filename):
-            with open(filename, "r") as f:
-                data = json.load(f)
-                prompts_queue = data.get("prompts", [])
-        else:
-            prompts_queue = []
-        
-        # Add new prompt to the queue
-        prompts_queue.append({
-            "developerPrompt": developerPrompt + " Use this observation to make initiate small talk with the user"
-        })
-        
-        # Write updated queue back to file
-        with open(filename, "w") as f:
-            json.dump({"prompts": prompts_queue}, f, indent=2)
-        
+        submitPrompt(developerPrompt + " Use this observation to make initiate small talk with the user", PRIORITY_OBSERVATION, "webcam")
         return "Function executed successfully"
         
     except Exception as e:
-        print(f"Failed to write prompt file: {e}")
-        return (f"Failed to write prompt file: {e}")
-        
\ No newline at end of file
+        print(f"Failed to deliver prompt: {e}")
+        return (f"Failed to deliver prompt: {e}")